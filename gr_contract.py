@@ -0,0 +1,107 @@
+import osmnx  as ox
+import networkx as nx
+
+# Routing graph of a network for the k-shortest-paths search: the weakly connected component that holds the trail,
+# without its dead ends and with the chains of nodes that only connect two other nodes contracted into single edges.
+# The nodes that are routed between (the ends of the pieces) are never removed, and every contracted path is expanded
+# back to the original nodes, so the segments are extracted from the original edges as before.
+
+# Returns the weakly connected component of a digraph that holds most of the given nodes
+def get_trail_component(digraph, node_ids):
+
+    counts = {}
+    components = list(nx.weakly_connected_components(digraph))
+    for c, component in enumerate(components):
+        counts[c] = sum(node_id in component for node_id in node_ids)
+    best = max(counts, key=lambda c: (counts[c], len(components[c])))
+    return components[best]
+
+# Returns the node list of an edge of the contracted digraph in the original digraph
+def get_chain(chains, u, v):
+
+    return chains.get((u,v), [u,v])
+
+# True if node v only connects two other nodes: one-way (a -> v -> b) or in both directions (a <-> v <-> b)
+def is_chain_node(digraph, v, protected):
+
+    if v in protected or digraph.has_edge(v,v):
+        return False
+    pred = set(digraph.predecessors(v))
+    succ = set(digraph.successors(v))
+    if len(pred | succ)!=2:
+        return False
+    return pred==succ or (len(pred)==1 and len(succ)==1)
+
+# Removes the nodes that no path between two protected nodes can pass through: dead ends (a single neighbour, the path
+# would have to leave along the way it came) and nodes that can only be entered or only be left
+def prune_dead_ends(graph, protected):
+
+    stack = [v for v in graph.nodes if v not in protected]
+    while len(stack)>0:
+        v = stack.pop()
+        if v in protected or v not in graph:
+            continue
+        pred = set(graph.predecessors(v)) - {v}
+        succ = set(graph.successors(v)) - {v}
+        if len(pred | succ)<=1 or len(pred)==0 or len(succ)==0:
+            graph.remove_node(v)
+            stack.extend(pred | succ)
+    return graph
+
+# Contracts the chain nodes of a digraph, returns the contracted digraph and the node list of every contracted edge
+# A chain node is kept when its contraction would create an edge that already exists, so no path is lost
+def contract_digraph(digraph, protected):
+
+    graph = nx.DiGraph()
+    graph.add_nodes_from(digraph.nodes)
+    graph.add_weighted_edges_from(((u, v, data['length']) for u, v, data in digraph.edges(data=True)), weight='length')
+    graph = prune_dead_ends(graph, protected)
+    chains = {}
+
+    for v in list(graph.nodes):
+        if not is_chain_node(graph, v, protected):
+            continue
+        pred = list(graph.predecessors(v))
+        succ = list(graph.successors(v))
+        if len(pred)==2: # Both directions
+            a, b = pred
+            pairs = [(a,b), (b,a)]
+        else:
+            pairs = [(pred[0], succ[0])]
+        if any(u==w or graph.has_edge(u,w) for u, w in pairs):
+            continue
+
+        for u, w in pairs:
+            graph.add_edge(u, w, length=graph[u][v]['length'] + graph[v][w]['length'])
+            chains[(u,w)] = get_chain(chains, u, v) + get_chain(chains, v, w)[1:]
+        for u, w in [(u,v) for u in pred] + [(v,w) for w in succ]:
+            chains.pop((u,w), None)
+        graph.remove_node(v)
+
+    return graph, chains
+
+# Builds the routing graph of a network for routing between the given nodes, it is used by gr_mapmatch.get_k_paths
+# Queries between nodes that are not in the routing graph are searched on the full digraph
+def prepare_routing(network, node_ids):
+
+    if 'digraph' not in network:
+        network['digraph'] = ox.convert.to_digraph(network['graph'], weight='length')
+    protected = set(node_ids)
+    component = get_trail_component(network['digraph'], protected)
+    digraph, chains = contract_digraph(network['digraph'].subgraph(component), protected)
+    network['routing'] = {'digraph':digraph, 'chains':chains}
+    return network
+
+# Expands a path of the contracted digraph into the nodes of the original digraph
+def expand_path(routing, path):
+
+    nodes = [path[0]]
+    for u, v in zip(path[:-1], path[1:]):
+        nodes.extend(get_chain(routing['chains'], u, v)[1:])
+    return nodes
+
+def print_stats(network):
+
+    n0 = network['digraph'].number_of_nodes()
+    n1 = network['routing']['digraph'].number_of_nodes()
+    print(f'   Routing graph: {n1} of {n0} nodes, {len(network["routing"]["chains"])} contracted edges')
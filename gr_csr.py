@@ -0,0 +1,322 @@
+import numpy  as np
+import networkx as nx
+import heapq
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+# Compact routing graph in compressed sparse row (CSR) form, built from the points & edges frames of a network.
+# Nodes are int32 indices into the sorted OSM node IDs, every directed node pair keeps its shortest parallel edge
+# (like ox.convert.to_digraph), and edge_row points to that edge in network['edges'] for its attributes.
+# Paths are computed with scipy.sparse.csgraph and returned as lists of OSM node IDs.
+# Lengths are kept in float64, float32 would reorder paths whose lengths differ by less than its precision.
+#
+# For a known sequence of queries (e.g. the pieces of a trail), open_trees schedules one shortest path tree per source
+# node. The trees of the next batch sources are built by a single bounded Dijkstra call, and every tree answers all
+# queries from its source: the forward query of the next piece, the reverse query of the previous piece and the first
+# candidate of Yen's algorithm. A query whose target lies beyond the bound of its tree falls back to a full search.
+
+# Search limit of the first path search [m], doubled until the end node is reached
+first_limit = 500.0
+# The spur searches of Yen's algorithm start with a bound of spur_detour (at least 1) times the length of the first path
+# plus first_limit
+spur_detour = 2.0
+
+# Builds the CSR graph of the points & edges frames of a network
+def build_csr(points, edges):
+
+    node_ids = points.index.values.astype(np.int64) # Sorted by graph_to_network
+    u = np.searchsorted(node_ids, edges.index.get_level_values(0).values).astype(np.int32)
+    v = np.searchsorted(node_ids, edges.index.get_level_values(1).values).astype(np.int32)
+    length = edges['length'].values.astype(float)
+    rows = np.arange(len(edges), dtype=np.int32)
+
+    # Keep the shortest of the parallel edges between each node pair, and drop self-loops
+    order = np.lexsort((length, v, u))
+    u, v, length, rows = u[order], v[order], length[order], rows[order]
+    first = np.ones(len(u), dtype=bool)
+    first[1:] = (u[1:]!=u[:-1]) | (v[1:]!=v[:-1])
+    keep = first & (u!=v)
+    u, v, length, rows = u[keep], v[keep], length[keep], rows[keep]
+
+    return make_csr(node_ids, u, v, length, rows)
+
+# Returns the CSR graph of edges u -> v (node indices into node_ids, sorted on u) with the given lengths
+def make_csr(node_ids, u, v, lengths, rows):
+
+    indptr = np.zeros(len(node_ids) + 1, dtype=np.int32)
+    np.cumsum(np.bincount(u, minlength=len(node_ids)), out=indptr[1:])
+    in_edges = np.argsort(v, kind='stable').astype(np.int32) # Incoming edges of each node, to block nodes in Yen's algorithm
+    in_indptr = np.zeros(len(node_ids) + 1, dtype=np.int32)
+    np.cumsum(np.bincount(v, minlength=len(node_ids)), out=in_indptr[1:])
+
+    return {'node_ids':node_ids, 'indptr':indptr, 'indices':v.astype(np.int32), 'lengths':lengths, 'edge_row':rows,
+            'in_indptr':in_indptr, 'in_edges':in_edges}
+
+# Returns the number of bytes held by the arrays of a CSR graph
+def get_nbytes(csr):
+
+    return sum(value.nbytes for value in csr.values() if isinstance(value, np.ndarray))
+
+# Returns the index of an OSM node ID, raises nx.NodeNotFound like NetworkX if the node is not in the graph
+def get_index(csr, node_id):
+
+    i = np.searchsorted(csr['node_ids'], node_id)
+    if i>=len(csr['node_ids']) or csr['node_ids'][i]!=node_id:
+        raise nx.NodeNotFound(f'Node {node_id} not found in graph')
+    return int(i)
+
+# Schedules the shortest path trees for a sequence of (start, end) node ID pairs, limits holds the search bound of every
+# pair [m]. Both ends of every pair are sources, so the queries in both directions are answered by the trees
+def open_trees(csr, pairs, limits, batch=16):
+
+    trees = {'sources':[], 'limits':[], 'position':{}, 'rows':{}, 'batch':max(int(batch), 1),
+             'searches':0, 'hits':0, 'fallbacks':0}
+    for (node_id_start, node_id_end), limit in zip(pairs, limits):
+        for node_id in (node_id_start, node_id_end):
+            i = int(np.searchsorted(csr['node_ids'], node_id))
+            if i>=len(csr['node_ids']) or csr['node_ids'][i]!=node_id:
+                continue # Not in the graph, the query raises nx.NodeNotFound as usual
+            if i not in trees['position']:
+                trees['position'][i] = len(trees['sources'])
+                trees['sources'].append(i)
+                trees['limits'].append(limit)
+            p = trees['position'][i]
+            trees['limits'][p] = max(trees['limits'][p], limit)
+    return trees
+
+# Returns the distance & predecessor rows of the tree of node index s, or None if s is not a scheduled source
+# The trees of earlier sources are dropped, so at most batch trees are held at once
+def get_tree(csr, trees, s):
+
+    if s not in trees['position']:
+        return None
+    if s not in trees['rows']:
+        p = trees['position'][s]
+        sources = trees['sources'][p:p+trees['batch']]
+        dist, pred = dijkstra(get_matrix(csr), indices=sources, return_predecessors=True, limit=max(trees['limits'][p:p+trees['batch']]))
+        trees['rows'] = {source:(dist[j], pred[j]) for j, source in enumerate(sources)}
+        trees['searches'] += 1
+    return trees['rows'][s]
+
+# Returns the distance to node index t and the path from the tree of node index s as node indices
+# Returns None when the tree can not answer the query: s is not a source or t lies beyond the bound of the tree
+def get_tree_path(csr, trees, s, t):
+
+    tree = None if trees is None else get_tree(csr, trees, s)
+    if tree is None:
+        return None
+    dist, pred = tree
+    if not np.isfinite(dist[t]):
+        trees['fallbacks'] += 1
+        return None
+    trees['hits'] += 1
+    path = [t]
+    while path[-1]!=s:
+        path.append(pred[path[-1]])
+    return dist[t], path[::-1]
+
+def print_tree_stats(trees):
+
+    print(f'Shortest path trees: {len(trees["sources"])} sources in {trees["searches"]} Dijkstra calls, '
+          f'{trees["hits"]} queries answered, {trees["fallbacks"]} beyond the bound')
+
+# Returns the sparse matrix of the CSR graph, built once. Its data array is csr['lengths'] itself, so edges are blocked
+# by setting their lengths to np.inf in place (and restoring them), without building a new matrix per search
+def get_matrix(csr):
+
+    if 'matrix' not in csr:
+        n = len(csr['node_ids'])
+        csr['matrix'] = csr_matrix((csr['lengths'], csr['indices'], csr['indptr']), shape=(n,n), copy=False)
+    return csr['matrix']
+
+# Returns the matrix of the reversed CSR graph (edges v -> u), to search the distances towards a node
+def get_reverse_matrix(csr):
+
+    if 'reverse_matrix' not in csr:
+        csr['reverse_matrix'] = get_matrix(csr).transpose().tocsr()
+    return csr['reverse_matrix']
+
+# Returns the positions of the outgoing edges of the given node indices in CSR arrays with the given indptr
+def get_out_edges(indptr, nodes):
+
+    starts = indptr[nodes]
+    counts = indptr[nodes+1] - starts
+    return np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+# True if a search that did not reach every node stopped at its limit: a reached node has an open edge to a node that
+# was not reached. Otherwise the search saw every node that can be reached at all
+def is_truncated(matrix, dist):
+
+    positions = get_out_edges(matrix.indptr, np.flatnonzero(np.isfinite(dist)))
+    return bool(np.any(np.isfinite(matrix.data[positions]) & ~np.isfinite(dist[matrix.indices[positions]])))
+
+# Returns the CSR graph of the nodes that can lie on a path from node index s to node index t no longer than bound [m]
+# (the distance from s plus the distance to t is at most bound), so that all these paths can be searched on a small
+# graph. If the searches from s and towards t reached every node they can, the subgraph holds every node of every path
+# from s to t and is complete: a spur search that fails on it fails on the whole graph too
+def get_subgraph(csr, s, t, bound):
+
+    limit = bound*(1 + 1e-9) # Margin for the rounding of the lengths of paths of length bound
+    dist_start = dijkstra(get_matrix(csr), indices=s, limit=limit)
+    dist_end = dijkstra(get_reverse_matrix(csr), indices=t, limit=limit)
+    complete = not is_truncated(get_matrix(csr), dist_start) and not is_truncated(get_reverse_matrix(csr), dist_end)
+    if complete:
+        nodes = np.flatnonzero(np.isfinite(dist_start) & np.isfinite(dist_end))
+    else:
+        nodes = np.flatnonzero(dist_start + dist_end<=limit)
+
+    local = np.full(len(csr['node_ids']), -1, dtype=np.int32) # Index of every node in the subgraph
+    local[nodes] = np.arange(len(nodes), dtype=np.int32)
+    positions = get_out_edges(csr['indptr'], nodes)
+    u = np.repeat(np.arange(len(nodes), dtype=np.int32), csr['indptr'][nodes+1] - csr['indptr'][nodes])
+    v = local[csr['indices'][positions]]
+    keep = v>=0
+    sub = make_csr(csr['node_ids'][nodes], u[keep], v[keep], csr['lengths'][positions[keep]], csr['edge_row'][positions[keep]])
+    sub['complete'] = complete
+    return sub
+
+# Runs Dijkstra from node index s on the current edge lengths (np.inf blocks an edge), searching no further than limit
+# Returns the distance to node index t and the path as node indices, or (np.inf, None) if t was not reached, and
+# whether t may still be reachable beyond the limit (only checked with check_truncated=True)
+def get_index_path(csr, s, t, limit=np.inf, check_truncated=True):
+
+    dist, pred = dijkstra(get_matrix(csr), indices=s, return_predecessors=True, limit=limit)
+    if not np.isfinite(dist[t]):
+        return np.inf, None, check_truncated and bool(np.isfinite(limit)) and is_truncated(get_matrix(csr), dist)
+    path = [t]
+    while path[-1]!=s:
+        path.append(pred[path[-1]])
+    return dist[t], path[::-1], False
+
+# Returns the distance and node indices of the shortest path from s to t, or (np.inf, None) if there is no path
+# Most queries connect nearby nodes, so the search starts within first_limit and doubles the limit until t is reached
+# or the search reached every node it can, rather than spreading over the whole graph every time
+def get_first_path(csr, s, t):
+
+    limit = first_limit
+    while True:
+        dist, path, truncated = get_index_path(csr, s, t, limit)
+        if not truncated:
+            return dist, path
+        limit *= 2
+
+# Blocks the given edge positions while searching from s to t, returns the result of get_index_path
+def get_blocked_path(csr, blocked, s, t, limit, check_truncated):
+
+    saved = csr['lengths'][blocked]
+    csr['lengths'][blocked] = np.inf
+    try:
+        return get_index_path(csr, s, t, limit, check_truncated)
+    finally:
+        csr['lengths'][blocked] = saved
+
+# Returns the position of edge i -> j in the CSR arrays
+def get_edge(csr, i, j):
+
+    start, end = csr['indptr'][i], csr['indptr'][i+1]
+    return start + int(np.flatnonzero(csr['indices'][start:end]==j)[0])
+
+# Adds the spur paths of accepted path j to the candidates (one step of Yen's algorithm) on subgraph sub, searching no
+# further than bound [m] from the start node. accepted holds (length, node indices of sub, deviation) per path,
+# candidates and seen hold OSM node IDs. Returns True if a spur path longer than bound may have been missed
+# The spur nodes before the node where path j deviates from the path it was found from were searched for that path
+# already (Lawler's refinement of Yen's algorithm)
+def add_spur_paths(sub, accepted, j, t, k, bound, candidates, seen):
+
+    length, last, deviation = accepted[j]
+    root_length = sum(sub['lengths'][get_edge(sub, last[i], last[i+1])] for i in range(deviation))
+    truncated = False
+    for i in range(deviation, len(last)-1):
+        spur = last[i]
+        root = last[:i+1]
+
+        # Candidates longer than the k-th shortest candidate so far can not be among the k paths
+        limit = bound
+        if len(accepted) + len(candidates)>=k:
+            limit = min(bound, heapq.nsmallest(k - len(accepted), candidates)[-1][0])
+        if root_length>=limit: # The roots only get longer, so neither can the next spur paths
+            return truncated or limit==bound
+
+        # Block the next edge of every accepted path with the same root, and the root nodes before the spur node
+        blocked = [get_edge(sub, path[i], path[i+1]) for length, path, d in accepted if len(path)>i+1 and path[:i+1]==root]
+        for node in root[:-1]:
+            blocked.extend(range(sub['indptr'][node], sub['indptr'][node+1]))
+            blocked.extend(sub['in_edges'][sub['in_indptr'][node]:sub['in_indptr'][node+1]])
+
+        dist, spur_path, spur_truncated = get_blocked_path(sub, np.array(blocked, dtype=np.int64), spur, t,
+                                                           limit - root_length, limit==bound and sub['complete'])
+        if spur_path is None and limit==bound: # Paths beyond the bound are not in an incomplete subgraph
+            truncated = truncated or spur_truncated or not sub['complete']
+        if spur_path is not None:
+            path = sub['node_ids'][root[:-1] + spur_path].tolist()
+            if tuple(path) not in seen:
+                seen.add(tuple(path))
+                heapq.heappush(candidates, (root_length + dist, path, i))
+
+        root_length += sub['lengths'][get_edge(sub, last[i], last[i+1])]
+    return truncated
+
+# Returns True if the graph holds all nodes and edges of a path given as OSM node IDs
+def has_path(csr, node_ids):
+
+    path = np.searchsorted(csr['node_ids'], node_ids)
+    if np.any(path>=len(csr['node_ids'])) or np.any(csr['node_ids'][np.minimum(path, len(csr['node_ids'])-1)]!=node_ids):
+        return False
+    return all(np.any(csr['indices'][csr['indptr'][path[j]]:csr['indptr'][path[j]+1]]==path[j+1]) for j in range(len(path)-1))
+
+# Returns the length of a path given as OSM node IDs [m], taking the shortest of parallel edges
+def get_path_length(csr, node_ids):
+
+    path = np.searchsorted(csr['node_ids'], node_ids)
+    return sum(csr['lengths'][get_edge(csr, path[j], path[j+1])] for j in range(len(path)-1))
+
+# Calculates the shortest path between two nodes, like ox.shortest_path (None if there is no path)
+# With trees (see open_trees), the path is taken from the tree of the start node when it reaches the end node
+def shortest_path(csr, node_id_start, node_id_end, trees=None):
+
+    s = get_index(csr, node_id_start)
+    t = get_index(csr, node_id_end)
+    dist, path = get_tree_path(csr, trees, s, t) or get_first_path(csr, s, t)
+    return None if path is None else csr['node_ids'][path].tolist()
+
+# Lazily generates up to k shortest simple paths between two nodes, in order of increasing length (Yen's algorithm)
+# Raises nx.NetworkXNoPath like nx.shortest_simple_paths when there is no path at all
+# With trees (see open_trees), the first path is taken from the tree of the start node when it reaches the end node
+# The spur paths are searched on the subgraph of the paths no longer than a bound around the first path. Every candidate
+# within the bound is found, so the shortest candidate is the next path as long as there is one. When there is none but
+# a spur path may lie beyond the bound, the bound is doubled and the spur paths of all accepted paths are searched again
+def k_shortest_paths(csr, node_id_start, node_id_end, k, trees=None):
+
+    s = get_index(csr, node_id_start)
+    t = get_index(csr, node_id_end)
+    dist, path = get_tree_path(csr, trees, s, t) or get_first_path(csr, s, t)
+    if path is None:
+        raise nx.NetworkXNoPath(f'No path between {node_id_start} and {node_id_end}')
+
+    accepted = [(dist, csr['node_ids'][path].tolist(), 0)] # Length, OSM node IDs and deviation of the paths found so far
+    candidates = [] # Heap of (length, OSM node IDs, deviation)
+    seen = {tuple(accepted[0][1])}
+    bound = spur_detour*dist + first_limit
+    sub = None
+    searched = 0 # Number of accepted paths whose spur paths were searched within the bound
+    truncated = False
+    yield accepted[0][1]
+
+    while len(accepted)<k:
+        if sub is None:
+            sub = get_subgraph(csr, s, t, bound)
+        accepted_sub = [(length, np.searchsorted(sub['node_ids'], path).tolist(), d) for length, path, d in accepted]
+        for j in range(searched, len(accepted)):
+            truncated = add_spur_paths(sub, accepted_sub, j, get_index(sub, node_id_end), k, bound, candidates, seen) or truncated
+        searched = len(accepted)
+
+        if len(candidates)==0:
+            if not truncated:
+                return
+            bound *= 2
+            sub = None
+            searched = 0
+            truncated = False
+            continue
+        accepted.append(heapq.heappop(candidates))
+        yield accepted[-1][1]
@@ -0,0 +1,89 @@
+import osmnx  as ox
+import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from osmnx._errors import ResponseStatusCodeError
+
+# Background fetch layer for the OSM downloads of upcoming batches. While batch b is matched, the downloads of batches
+# b+1..b+lookahead run on a few threads, so the download latency is hidden behind the matching. All requests (in the
+# background or not) share a rate limit and a bounded number of concurrent requests, and failed requests are retried
+# with an exponential backoff. Downloads are plain function calls (e.g. ox.graph_from_bbox), results are keyed by the
+# caller, e.g. on the bbox of the batch.
+
+# Network errors that are worth retrying, an empty response (ValueError) is an answer and is not retried
+retry_errors = (requests.exceptions.RequestException, ResponseStatusCodeError, ConnectionError, TimeoutError)
+
+# Opens a fetcher, rate is the maximum number of requests started per second and concurrency the maximum number of
+# requests running at once. endpoint replaces the Overpass API url, e.g. to test against a local server. OSMnx only has
+# a global url, so it applies to all downloads until the fetcher is closed, which restores the previous url
+def open_fetcher(lookahead=2, concurrency=2, rate=1.0, retries=4, backoff=2.0, endpoint=None):
+
+    overpass_url = ox.settings.overpass_url
+    if endpoint is not None:
+        ox.settings.overpass_url = endpoint
+    return {'pool':ThreadPoolExecutor(max_workers=concurrency), 'semaphore':threading.BoundedSemaphore(concurrency),
+            'lock':threading.Lock(), 'interval':1.0/rate if rate else 0.0, 'next_time':0.0,
+            'lookahead':lookahead, 'retries':retries, 'backoff':backoff, 'futures':{},
+            'endpoint':endpoint, 'overpass_url':overpass_url,
+            'hits':0, 'misses':0, 'retried':0, 'wait':0.0}
+
+# Blocks until the rate limit allows the next request
+def wait_for_slot(fetcher):
+
+    with fetcher['lock']:
+        now = time.monotonic()
+        start = max(now, fetcher['next_time'])
+        fetcher['next_time'] = start + fetcher['interval']
+    time.sleep(start - now)
+
+# Calls function(*args) within the rate limit, retrying with an exponential backoff when the request fails
+def call_with_retry(fetcher, function, args):
+
+    for attempt in range(fetcher['retries'] + 1):
+        with fetcher['semaphore']:
+            wait_for_slot(fetcher)
+            try:
+                return function(*args)
+            except retry_errors as error:
+                if attempt==fetcher['retries']:
+                    raise
+                delay = fetcher['backoff']*2**attempt
+                with fetcher['lock']:
+                    fetcher['retried'] += 1
+                print(f'   Download failed ({error!r}), retrying in {delay:.1f} s...')
+        time.sleep(delay) # Outside the semaphore, so other requests can go ahead meanwhile
+
+# Starts function(*args) in the background, its result is picked up with fetch using the same key
+def prefetch(fetcher, key, function, *args):
+
+    if key not in fetcher['futures']:
+        fetcher['futures'][key] = fetcher['pool'].submit(call_with_retry, fetcher, function, args)
+
+# Returns the result of function(*args), waiting for the background download if it was prefetched
+# Errors of a background download (e.g. no data inside the bbox) are raised here, as if it was downloaded now
+def fetch(fetcher, key, function, *args):
+
+    future = fetcher['futures'].pop(key, None)
+    if future is None:
+        fetcher['misses'] += 1
+        return call_with_retry(fetcher, function, args)
+
+    fetcher['hits'] += 1
+    t0 = time.time()
+    result = future.result()
+    fetcher['wait'] += time.time() - t0
+    return result
+
+def print_stats(fetcher):
+
+    print(f'Fetcher: {fetcher["hits"]} prefetched and {fetcher["misses"]} direct downloads, '
+          f'{fetcher["retried"]} retries, {fetcher["wait"]:.1f} s spent waiting for prefetched downloads')
+
+# Drops the downloads that were not picked up, stops the background threads and restores the Overpass API url
+def close_fetcher(fetcher):
+
+    fetcher['pool'].shutdown(wait=True, cancel_futures=True)
+    fetcher['futures'] = {}
+    if fetcher['endpoint'] is not None:
+        ox.settings.overpass_url = fetcher['overpass_url']
@@ -0,0 +1,219 @@
+import osmnx  as ox
+import networkx as nx
+from osmnx._errors import InsufficientResponseError
+import numpy  as np
+import hashlib
+import pickle
+import json
+import os.path
+from datetime import date
+
+# Highway values that are dropped by the "all_private" network type of OSMnx
+excluded_highway = ['abandoned','construction','no','planned','platform','proposed','raceway','razed']
+
+# Returns the (i, j) key of the grid tile that contains a lat/lon point
+def get_tile_key(lat, lon, tile_size):
+
+    return int(np.floor(lat/tile_size)), int(np.floor(lon/tile_size))
+
+# Returns the keys of all grid tiles that overlap with a bounding box
+def get_tile_keys(lat_min, lat_max, lon_min, lon_max, tile_size):
+
+    i0, j0 = get_tile_key(lat_min, lon_min, tile_size)
+    i1, j1 = get_tile_key(lat_max, lon_max, tile_size)
+    return [(i,j) for i in range(i0,i1+1) for j in range(j0,j1+1)]
+
+# Returns the bounding box of a grid tile
+def get_tile_bbox(key, tile_size):
+
+    lat_min = key[0]*tile_size
+    lon_min = key[1]*tile_size
+    return lat_min, lat_min + tile_size, lon_min, lon_min + tile_size
+
+def get_tile_filename(store, key):
+
+    return os.path.join(store['path'], f'tile_{key[0]}_{key[1]}.pkl')
+
+def get_file_hash(filename):
+
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+# Removes the edges that are not part of an "all_private" network, as well as the nodes left without edges
+def filter_network(graph):
+
+    drop = []
+    for u, v, k, data in graph.edges(keys=True, data=True):
+        highway = data.get('highway')
+        if highway is None or highway in excluded_highway or data.get('area')=='yes':
+            drop.append((u,v,k))
+    graph.remove_edges_from(drop)
+    graph.remove_nodes_from(list(nx.isolates(graph)))
+    return graph
+
+# Loads the unsimplified street network from a local .osm/.xml or .pbf extract
+def load_extract(filename_osm):
+
+    if filename_osm.endswith('.pbf'):
+        try:
+            import pyrosm
+        except ImportError:
+            raise ImportError('Reading .pbf extracts requires the pyrosm package, or convert the extract to .osm first.')
+        osm = pyrosm.OSM(filename_osm)
+        nodes, edges = osm.get_network(network_type='all', nodes=True)
+        graph = osm.to_graph(nodes, edges, graph_type='networkx')
+    else:
+        graph = ox.graph_from_xml(filename_osm, simplify=False, retain_all=True)
+    return filter_network(graph)
+
+# Cuts a region-wide street network into tiles, edges that cross a tile border are stored in both tiles
+def split_tiles(graph, tile_size):
+
+    node_ids = list(graph.nodes)
+    lat = np.array([graph.nodes[node_id]['y'] for node_id in node_ids])
+    lon = np.array([graph.nodes[node_id]['x'] for node_id in node_ids])
+    node_keys = dict(zip(node_ids, zip(np.floor(lat/tile_size).astype(int).tolist(),
+                                       np.floor(lon/tile_size).astype(int).tolist())))
+
+    tile_edges = {}
+    for u, v, k in graph.edges(keys=True):
+        tile_edges.setdefault(node_keys[u], []).append((u,v,k))
+        if node_keys[v]!=node_keys[u]:
+            tile_edges.setdefault(node_keys[v], []).append((u,v,k))
+
+    return {key:graph.edge_subgraph(edges).copy() for key, edges in tile_edges.items()}
+
+# Tiles and store info are written to a temporary file and renamed, so processes that share a store never read a
+# partially written file
+def write_tile(store, key, graph):
+
+    filename = get_tile_filename(store, key)
+    with open(f'{filename}.{os.getpid()}', 'wb') as file:
+        pickle.dump(graph, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f'{filename}.{os.getpid()}', filename)
+
+# The tiles listed on disk for the same store version are merged in, so processes that download tiles at the same time
+# keep each other's tiles
+def write_store_info(store):
+
+    filename = os.path.join(store['path'], 'store.json')
+    if os.path.isfile(filename):
+        with open(filename) as file:
+            info = json.load(file)
+        if info['version']==store['version'] and info['source']==store['source']:
+            store['tiles'].update(tuple(key) for key in info['tiles'])
+    info = {'tile_size':store['tile_size'], 'version':store['version'], 'source':store['source'],
+            'tiles':sorted(store['tiles'])}
+    with open(f'{filename}.{os.getpid()}', 'w') as file:
+        json.dump(info, file)
+    os.replace(f'{filename}.{os.getpid()}', filename)
+
+# Builds a tiled graph store from a local OSM extract, this only needs to be done once per region
+def build_store(store_path, filename_osm, tile_size=0.05):
+
+    os.makedirs(store_path, exist_ok=True)
+    print(f'Loading street network from <{filename_osm}>...')
+    graph = load_extract(filename_osm)
+    print(f'Splitting {len(graph)} nodes into tiles of {tile_size} deg...')
+    tiles = split_tiles(graph, tile_size)
+
+    store = {'path':store_path, 'tile_size':tile_size, 'source':filename_osm,
+             'version':get_file_hash(filename_osm)[:16], 'tiles':set(tiles.keys()), 'memory':{}}
+    for key, tile in tiles.items():
+        write_tile(store, key, tile)
+    write_store_info(store)
+    print(f'Stored {len(tiles)} tiles in <{store_path}>.')
+
+    return store
+
+# Opens an existing graph store, or creates an empty one whose tiles are downloaded from OSM when first needed
+def open_store(store_path, tile_size=0.05):
+
+    filename = os.path.join(store_path, 'store.json')
+    if os.path.isfile(filename):
+        with open(filename) as file:
+            info = json.load(file)
+        return {'path':store_path, 'tile_size':info['tile_size'], 'source':info['source'],
+                'version':info['version'], 'tiles':set(tuple(key) for key in info['tiles']), 'memory':{}}
+
+    os.makedirs(store_path, exist_ok=True)
+    store = {'path':store_path, 'tile_size':tile_size, 'source':None,
+             'version':f'overpass-{date.today().isoformat()}', 'tiles':set(), 'memory':{}}
+    write_store_info(store)
+    return store
+
+# Downloads the unsimplified street network of a single tile
+def download_tile(store, key):
+
+    lat_min, lat_max, lon_min, lon_max = get_tile_bbox(key, store['tile_size'])
+    return ox.graph_from_bbox(lat_max, lat_min, lon_max, lon_min,
+                              network_type="all_private", clean_periphery=False,
+                              simplify=False, retain_all=True, truncate_by_edge=True)
+
+# Returns the graph of a single tile from memory, from disk, or (for online stores) from OSM
+def get_tile(store, key):
+
+    if key in store['memory']:
+        return store['memory'][key]
+
+    tile = None
+    if key not in store['tiles'] and store['source'] is None and os.path.isfile(get_tile_filename(store, key)):
+        store['tiles'].add(key) # Downloaded by another process sharing the store
+    if key in store['tiles']:
+        with open(get_tile_filename(store, key), 'rb') as file:
+            tile = pickle.load(file)
+    elif store['source'] is None: # Online store, tile was not downloaded before
+        try:
+            tile = download_tile(store, key)
+        except InsufficientResponseError: # No street network inside this tile, failed requests raise and are not stored
+            tile = nx.MultiDiGraph(crs=ox.settings.default_crs)
+        write_tile(store, key, tile)
+        store['tiles'].add(key)
+        write_store_info(store)
+
+    store['memory'][key] = tile # Offline stores hold no tile where the extract has no streets
+    return tile
+
+# Composes the stored tiles with the given keys into a single unsimplified graph
+def compose_tiles(store, keys):
+
+    tiles = [get_tile(store, key) for key in keys]
+    tiles = [tile for tile in tiles if tile is not None and len(tile)>0]
+    if len(tiles)==0:
+        return None
+
+    graph = nx.compose_all(tiles)
+    graph.graph['crs'] = tiles[0].graph.get('crs', ox.settings.default_crs)
+    return graph
+
+# Assembles the street network within a bounding box from the stored tiles
+# The result matches what get_osm_network would download with ox.graph_from_bbox
+def get_graph(store, lat_min, lat_max, lon_min, lon_max):
+
+    graph = compose_tiles(store, get_tile_keys(lat_min, lat_max, lon_min, lon_max, store['tile_size']))
+    if graph is None:
+        raise ValueError(f'The graph store has no street network inside bbox {lat_min} {lat_max} {lon_min} {lon_max}')
+
+    graph = ox.truncate.truncate_graph_bbox(graph, lat_max, lat_min, lon_max, lon_min, retain_all=False)
+    graph = ox.simplify_graph(graph)
+    return graph
+
+# Assembles the street network within a (lon, lat) polygon from the stored tiles, like ox.graph_from_polygon
+def get_graph_polygon(store, polygon):
+
+    lon_min, lat_min, lon_max, lat_max = polygon.bounds
+    graph = compose_tiles(store, get_tile_keys(lat_min, lat_max, lon_min, lon_max, store['tile_size']))
+    if graph is None:
+        raise ValueError(f'The graph store has no street network inside polygon with bounds {polygon.bounds}')
+
+    graph = ox.truncate.truncate_graph_polygon(graph, polygon, retain_all=False)
+    graph = ox.simplify_graph(graph)
+    return graph
+
+# Drops the tiles held in memory, they are reloaded from disk when needed
+def clear_memory(store):
+
+    store['memory'] = {}
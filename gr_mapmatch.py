@@ -1,24 +1,71 @@
 import osmnx  as ox
 import pandas as pd
+import networkx as nx
 import numpy  as np
-from itertools import groupby
+import shapely
+import tracemalloc
+from itertools import groupby, islice
 import gr_utils # Contains useful geometry functions
+import gr_graphstore # Contains the tiled on-disk store of OSM street networks
+import gr_routecache # Contains the memo of path queries
+import gr_storage # Contains the typed storage of the pipeline stage outputs
+import gr_stagecache # Contains the content-addressed cache of the pipeline stages
+import gr_parallel # Contains the parallel execution of batches
+import gr_fetch # Contains the background fetch layer for OSM downloads
+import gr_contract # Contains the pruned and contracted routing graph
+import gr_csr # Contains the compact CSR routing graph
 from csv import writer
 import warnings
 import os.path
 
+# Margin [m] that the paths of a route cache entry keep from the border of a network cut from a graph store, for the
+# entry to be reused by the other networks of the store (see is_regional)
+region_margin = 200.0
+
 # Returns the latitude and longitude of a subsection of trail as a list
 def trail_to_coords(trail_section):
     
     return trail_section[['latitude','longitude']].values.tolist()
 
 # This function returns a list with the [lat, lon] of each point within an OSM edge
-# def edge_to_coords(network_edges,edge_id):
+# One-way edges that are only stored in the opposite direction are returned reversed
 def get_single_edge_coords(network, edge_id):
     
-    lon = list(network['edges'].loc[(edge_id[0],edge_id[1])]['geometry'][0].coords.xy[0])
-    lat = list(network['edges'].loc[(edge_id[0],edge_id[1])]['geometry'][0].coords.xy[1])
-    return [[coord[1],coord[0]] for coord in list(zip(lon,lat))]
+    return get_edge_coords(network['edge_table'], edge_id[0], edge_id[1]).tolist()
+
+# Builds a compact table of the edges, once per network, so edge lookups don't index the edges GeoDataFrame
+# The [lat, lon] points of edge row i are coords[offsets[i]:offsets[i+1]]
+def get_edge_table(edges):
+    
+    edges = edges[~edges.index.droplevel(2).duplicated(keep='first')] # Keep the first edge between each node pair
+    xy, geom_index = shapely.get_coordinates(edges['geometry'].values, return_index=True)
+    offsets = np.zeros(edges.shape[0]+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(geom_index, minlength=edges.shape[0]))
+    
+    # Hash from node pair to (row, reversed), the stored direction takes precedence over the reversed one
+    u = edges.index.get_level_values(0).tolist()
+    v = edges.index.get_level_values(1).tolist()
+    rows = range(edges.shape[0])
+    index = dict(zip(zip(v,u), zip(rows, [True]*len(u))))
+    index.update(zip(zip(u,v), zip(rows, [False]*len(u))))
+    
+    table = {'coords':xy[:,::-1].copy(), 'offsets':offsets, 'index':index,
+             'length':edges['length'].to_numpy(dtype=float)}
+    for key in ['highway','surface','tracktype']:
+        if key in edges.columns:
+            table[key] = edges[key].to_numpy(dtype=object)
+        else:
+            table[key] = np.full(edges.shape[0], np.nan, dtype=object)
+    return table
+
+# Returns the [lat, lon] points of the edge from node_id_start to node_id_end as an array
+def get_edge_coords(edge_table, node_id_start, node_id_end):
+    
+    row, flip = edge_table['index'][(node_id_start, node_id_end)]
+    edge_coords = edge_table['coords'][edge_table['offsets'][row]:edge_table['offsets'][row+1]]
+    if flip: # To deal with one-way streets
+        edge_coords = edge_coords[::-1]
+    return edge_coords
 
 # Returns the bounding box around a set of coords, and applies a tolerance around it
 def get_bbox(coords, delta):
@@ -30,20 +77,93 @@ def get_bbox(coords, delta):
     
     return lat_min, lat_max, lon_min, lon_max
     
+# Downloads the street network defined by a bounding box
+def download_graph(lat_min, lat_max, lon_min, lon_max):
+    
+    return ox.graph_from_bbox(lat_max, lat_min, lon_max, lon_min,
+                              network_type="all_private", clean_periphery=False)
+
 # Downloads the OSM network defined by a bounding box, and processes it into nodes & edges
-def get_osm_network(lat_min, lat_max, lon_min, lon_max):
+# If a graph store is given, the network is assembled from its cached tiles instead of downloaded
+# If a fetcher is given, the download goes through it and is picked up when it was prefetched (see gr_fetch)
+def get_osm_network(lat_min, lat_max, lon_min, lon_max, store=None, fetcher=None):
     
     # Download the street network based on bounding box
 #     print('   Downloading street network...')
-    graph = ox.graph_from_bbox(lat_max, lat_min, lon_max, lon_min,
-                               network_type="all_private", clean_periphery=False)
+    if store is not None:
+        graph = gr_graphstore.get_graph(store, lat_min, lat_max, lon_min, lon_max)
+    elif fetcher is not None:
+        graph = gr_fetch.fetch(fetcher, ('graph', lat_min, lat_max, lon_min, lon_max), download_graph,
+                               lat_min, lat_max, lon_min, lon_max)
+    else:
+        graph = download_graph(lat_min, lat_max, lon_min, lon_max)
     
     # Processing the street network
 #     print('   Processing street network...')
+    network = graph_to_network(graph)
+    if store is not None: # Part of the regional graph of the store, see gr_routecache
+        network['region'] = gr_stagecache.get_store_version(store)
+        network['bounds'] = shapely.box(lon_min, lat_min, lon_max, lat_max)
+    return network
+
+# Starts downloading the networks of the upcoming batches in the background, bboxes are (lat_min, lat_max, lon_min, lon_max)
+# Stores serve their tiles from disk, so there is nothing to prefetch
+def prefetch_networks(fetcher, bboxes, store=None):
+    
+    if fetcher is None or store is not None:
+        return
+    for bbox in bboxes[:fetcher['lookahead']]:
+        gr_fetch.prefetch(fetcher, ('graph',) + tuple(bbox), download_graph, *bbox)
+
+# Processes a street network into the network dict with nodes & edges, and the CSR graph the paths are searched on
+def graph_to_network(graph):
+    
     points, edges = ox.graph_to_gdfs(graph) # Convert the street network
     points.sort_index(inplace=True) # Sort the nodes for faster selections with .loc
     edges.sort_index(inplace=True) # Sort the edges for faster selections with .loc
-    return {'graph':graph, 'points':points, 'edges':edges}
+    edge_table = get_edge_table(edges) # Compact edge coordinates & properties for segment extraction
+    version = gr_routecache.get_network_version(edges) # Changes whenever the underlying OSM data change
+    csr = gr_csr.build_csr(points, edges) # Compact routing graph (see gr_csr)
+    return {'graph':graph, 'points':points, 'edges':edges, 'edge_table':edge_table, 'version':version, 'csr':csr}
+
+# Returns the network without its MultiDiGraph, for networks that are only routed on their CSR graph (see gr_csr)
+# The graph is the largest part of a network, nearest-edge lookups and the contracted routing graph still need it
+def drop_graph(network):
+    
+    return {key:value for key, value in network.items() if key not in ('graph', 'digraph')}
+
+# Returns the polygon of the corridor around the whole trail, in (lon, lat) coordinates
+def get_corridor(coords, delta):
+    
+    line = shapely.geometry.LineString(coords[['longitude','latitude']].values)
+    return line.buffer(delta)
+
+# Loads one OSM network that covers the corridor around the whole trail, instead of one network per batch
+# With report_memory=True, the memory held by the loaded network is measured and printed
+def get_corridor_network(coords, delta, store=None, report_memory=False):
+    
+    if report_memory:
+        tracemalloc.start()
+    
+    corridor = get_corridor(coords, delta)
+    if store is None:
+        graph = ox.graph_from_polygon(corridor, network_type="all_private", clean_periphery=False)
+    else:
+        graph = gr_graphstore.get_graph_polygon(store, corridor)
+    network = graph_to_network(graph)
+    network['corridor'] = corridor
+    if store is not None: # Part of the regional graph of the store, see gr_routecache
+        network['region'] = gr_stagecache.get_store_version(store)
+        network['bounds'] = corridor
+    
+    if report_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'Corridor network has {len(graph)} nodes and {len(graph.edges)} edges for {len(coords)} GPX points')
+        print(f'   Memory held: {current/1e6:.1f} MB (peak while loading: {peak/1e6:.1f} MB), '
+              f'of which {gr_csr.get_nbytes(network["csr"])/1e6:.1f} MB by the CSR routing graph')
+    
+    return network
 
 def sph2cart(lat, lon):
     
@@ -84,6 +204,160 @@ def get_nearest_edge_end(network, nearest_edge, X):
     else:
         return nearest_edge[1] # X is closest to the end of the edge
     
+# Array version of get_nearest_edge_end: figures out which end of each edge the corresponding point of X is closest to
+# The edge ends are taken from the node coordinates, which are the first and last points of the edge geometry
+def get_nearest_edge_ends(network, nearest_edges, X):
+    
+    edge_ids = np.array(nearest_edges, dtype=np.int64).reshape(-1,3) # Rows of [u, v, key]
+    X = np.array(X, dtype=float).reshape(-1,2) # Rows of [lat, lon]
+    node_coords = network['points'][['y','x']].to_numpy() # Rows of [lat, lon]
+    P0 = node_coords[network['points'].index.get_indexer(edge_ids[:,0])] # Start points
+    P1 = node_coords[network['points'].index.get_indexer(edge_ids[:,1])] # End points
+    
+    # Computing distances between P0<->X and P1<->X, converting degrees to radians
+    r0 = sph2cart(np.radians(P0[:,0]), np.radians(P0[:,1]))
+    r1 = sph2cart(np.radians(P1[:,0]), np.radians(P1[:,1]))
+    rX = sph2cart(np.radians(X[:,0]), np.radians(X[:,1]))
+    
+    d0 = mynorm([r0[0]-rX[0], r0[1]-rX[1], r0[2]-rX[2]])
+    d1 = mynorm([r1[0]-rX[0], r1[1]-rX[1], r1[2]-rX[2]])
+    
+    return np.where(d0 < d1, edge_ids[:,0], edge_ids[:,1]) # Closest to the start or to the end of the edge
+    
+# Lazily generates up to k shortest paths between two nodes, in order of increasing length
+# Same as ox.k_shortest_paths, but searched on the CSR graph of the network (see gr_csr) instead of a DiGraph per call
+# With a route cache, paths that were generated before on the same network are reused
+def get_k_paths(network, node_id_start, node_id_end, k, route_cache=None):
+    
+    if route_cache is None:
+        return generate_k_paths(network, node_id_start, node_id_end, k)
+    return get_cached_k_paths(network, node_id_start, node_id_end, k, route_cache)
+
+# With a routing graph (see gr_contract) that holds both nodes, the paths are searched on it and expanded afterwards
+def generate_k_paths(network, node_id_start, node_id_end, k):
+    
+    routing = network.get('routing')
+    if routing is not None and node_id_start in routing['digraph'] and node_id_end in routing['digraph']:
+        paths = nx.shortest_simple_paths(routing['digraph'], node_id_start, node_id_end, weight='length')
+        return (gr_contract.expand_path(routing, path) for path in islice(paths, 0, k))
+    
+    if 'csr' in network:
+        return gr_csr.k_shortest_paths(network['csr'], node_id_start, node_id_end, k, network.get('trees'))
+    
+    if 'digraph' not in network: # Networks built without a CSR graph
+        network['digraph'] = ox.convert.to_digraph(network['graph'], weight='length')
+    paths = nx.shortest_simple_paths(network['digraph'], node_id_start, node_id_end, weight='length')
+    return islice(paths, 0, k)
+
+def get_cached_k_paths(network, node_id_start, node_id_end, k, route_cache):
+    
+    query = ('k', node_id_start, node_id_end)
+    entry = gr_routecache.lookup(route_cache, network, query, lambda entry: holds_paths(network, entry['paths'], entry['lengths']))
+    if entry is None:
+        entry = {'paths':[], 'lengths':[], 'complete':False} # complete is True when there are no more paths to generate
+    yield from entry['paths'][:k]
+    if len(entry['paths'])>=k or entry['complete']:
+        return
+    
+    # Not enough paths cached, generate the remaining ones (the generator is deterministic)
+    lengths = entry.get('lengths') or [gr_csr.get_path_length(network['csr'], path) for path in entry['paths']] # Older entries hold no lengths
+    entry = {'paths':list(entry['paths']), 'lengths':list(lengths), 'complete':False} # The cached entry may be shared
+    j = -1
+    for j, path in enumerate(generate_k_paths(network, node_id_start, node_id_end, k)):
+        if j>=len(entry['paths']):
+            entry['paths'].append(path)
+            entry['lengths'].append(gr_csr.get_path_length(network['csr'], path))
+            store_route(route_cache, network, query, entry, entry['lengths'][-1])
+            yield path
+    if j+1<k: # There may be more paths on the rest of the store graph, so complete entries are not shared
+        entry['complete'] = True
+        store_route(route_cache, network, query, entry, None)
+
+# Calculates the shortest path between two nodes, like ox.shortest_path, reusing it from the route cache if given
+def get_shortest_path(network, node_id_start, node_id_end, route_cache=None):
+    
+    if route_cache is None:
+        return find_shortest_path(network, node_id_start, node_id_end)
+    
+    query = ('shortest', node_id_start, node_id_end)
+    entry = gr_routecache.lookup(route_cache, network, query, lambda entry: holds_paths(network, [entry['path']], [entry['length']]))
+    if entry is None:
+        path = find_shortest_path(network, node_id_start, node_id_end)
+        length = gr_csr.get_path_length(network['csr'], path) if path is not None else None
+        entry = {'path':path, 'length':length}
+        store_route(route_cache, network, query, entry, length)
+    return entry['path']
+
+# Returns True if the network holds all paths (given as OSM node IDs) with the same lengths [m]
+def holds_paths(network, paths, lengths):
+    
+    csr = network['csr']
+    for path, length in zip(paths, lengths):
+        if path is None or not gr_csr.has_path(csr, path) or not np.isclose(gr_csr.get_path_length(csr, path), length):
+            return False
+    return True
+
+# A path query on a network cut from a graph store has the same answer on the whole store graph when all paths up to
+# length [m] lie inside the network. Such paths stay within length/2 of the midpoint of the start and end nodes
+def is_regional(network, node_id_start, node_id_end, length):
+    
+    points = network['points'].loc[[node_id_start, node_id_end]]
+    lat = points['y'].mean()
+    lon = points['x'].mean()
+    dlat = (length/2 + region_margin)/111195.0 # [deg]
+    dlon = dlat/np.cos(np.radians(lat))
+    return network['bounds'].contains(shapely.box(lon - dlon, lat - dlat, lon + dlon, lat + dlat))
+
+# Stores a path query entry in the route cache, for all networks of the store when its paths up to length [m] are the
+# same on the whole store graph (see is_regional), otherwise for this network only
+def store_route(route_cache, network, query, entry, length):
+    
+    shared = 'region' in network and length is not None and is_regional(network, query[1], query[2], length)
+    gr_routecache.store(route_cache, network, query, entry, shared)
+
+# Schedules one bounded shortest path tree per node of the (start, end) node ID pairs that will be routed (see gr_csr)
+# The trees of batch nodes are built per Dijkstra call, and a tree searches up to detour times the straight-line distance
+# (plus margin [m]) of the pairs of its node, queries with longer paths fall back to a full search
+def prepare_trees(network, node_pairs, batch=16, detour=4.0, margin=1000.0):
+    
+    node_pairs = list(node_pairs)
+    if len(node_pairs)==0:
+        network['trees'] = None
+        return network
+    node_ids = np.array(node_pairs)
+    points = network['points'].reindex(np.unique(node_ids)) # Nodes that are not in the network get NaN coordinates
+    start = points.loc[node_ids[:,0]]
+    end = points.loc[node_ids[:,1]]
+    distance = cartesian_distance(start['y'].values, start['x'].values, end['y'].values, end['x'].values)
+    limits = np.nan_to_num(detour*distance + margin, nan=0.0)
+    network['trees'] = gr_csr.open_trees(network['csr'], node_pairs, limits, batch)
+    return network
+
+# Searches the shortest path on the CSR graph of the network, or on its MultiDiGraph for networks built without one
+def find_shortest_path(network, node_id_start, node_id_end):
+    
+    if 'csr' in network:
+        return gr_csr.shortest_path(network['csr'], node_id_start, node_id_end, network.get('trees'))
+    return ox.shortest_path(network['graph'], node_id_start, node_id_end)
+
+# Returns the spatial index of the edge geometries of a network, it is built the first time it is needed
+def get_edge_tree(network):
+    
+    if 'edge_tree' not in network:
+        network['edge_tree'] = shapely.STRtree(network['edges']['geometry'].values)
+    return network['edge_tree']
+
+# Lower bound on the error (see get_path_errors) of any path through the network
+# Each GPX point lies at least as far from a path as from the nearest edge of the network
+def get_error_bound(network, trail_coords):
+    
+    points = np.array(trail_coords, dtype=float).reshape(-1,2)
+    index, dist = get_edge_tree(network).query_nearest(shapely.points(points[:,1], points[:,0]),
+                                                       return_distance=True, all_matches=False)
+    dmin = np.full(points.shape[0], 999.0)
+    dmin[index[0]] = np.minimum(dist, 999)
+    return np.sum(dmin*dmin)
+    
 def cartesian_distance(lat0,lon0,lat1,lon1):
     
     R = 6371.8 # Mean earth radius [km]
@@ -102,15 +376,15 @@ def print_overwrite(text):
     print(text, end='\r', flush=True)
 
 # Calculates shortest route between two nodes of the network
-def get_shortest_route(network, node_id_start, node_id_end):
+def get_shortest_route(network, node_id_start, node_id_end, route_cache=None):
     
     # Calculating the routes in both directions
     node_start   = network['points'].loc[node_id_start] # Start node with relevant information
     node_end     = network['points'].loc[node_id_end]   # End node with relevant information
     vertex_start = [node_start['y'], node_start['x']] # Coordinates of start node
     vertex_end   = [node_end['y'],   node_end['x']]   # Coordinates of end node
-    route1 = ox.shortest_path(network['graph'], node_id_start, node_id_end) # Route from node_start -> node_end
-    route2 = ox.shortest_path(network['graph'], node_id_end, node_id_start) # Route from node_end -> node_start
+    route1 = get_shortest_path(network, node_id_start, node_id_end, route_cache) # Route from node_start -> node_end
+    route2 = get_shortest_path(network, node_id_end, node_id_start, route_cache) # Route from node_end -> node_start
 
     # Select the direction that results in the shortest path (we do this to deal with one-way streets)
     if len(route1)<len(route2):
@@ -119,7 +393,7 @@ def get_shortest_route(network, node_id_start, node_id_end):
         return route2[::-1] # We flip route2 because it runs opposite to the GPX track
     
 # Calculates shortest route between two nodes of the network
-def get_shortest_route_new(network, node_id_start, node_id_end):
+def get_shortest_route_new(network, node_id_start, node_id_end, route_cache=None):
     
     print(f'Calculating route between nodes {node_id_start} and {node_id_end}')
     # Calculating the routes in both directions
@@ -127,9 +401,9 @@ def get_shortest_route_new(network, node_id_start, node_id_end):
     node_end     = network['points'].loc[node_id_end]   # End node with relevant information
     vertex_start = [node_start['y'], node_start['x']] # Coordinates of start node
     vertex_end   = [node_end['y'],   node_end['x']]   # Coordinates of end node
-    route1 = ox.shortest_path(network['graph'], node_id_start, node_id_end) # Route from node_start -> node_end
-    route2 = ox.shortest_path(network['graph'], node_id_end, node_id_start) # Route from node_end -> node_start
-    route3 = ox.k_shortest_paths(network['graph'], node_id_start, node_id_end, 2) # TODO: REMOVE
+    route1 = get_shortest_path(network, node_id_start, node_id_end, route_cache) # Route from node_start -> node_end
+    route2 = get_shortest_path(network, node_id_end, node_id_start, route_cache) # Route from node_end -> node_start
+    route3 = get_k_paths(network, node_id_start, node_id_end, 2, route_cache) # TODO: REMOVE
     paths = []
     for path in route3:
         paths.append(path)
@@ -143,46 +417,28 @@ def get_shortest_route_new(network, node_id_start, node_id_end):
 
 def get_segments(network, node_id_start, node_id_end):
     
-    node_start   = network['points'].loc[node_id_start] # Start node with relevant information
-    node_end     = network['points'].loc[node_id_end]   # End node with relevant information
-    vertex_start = [node_start['y'], node_start['x']] # Coordinates of start node
-    vertex_end   = [node_end['y'],   node_end['x']]   # Coordinates of end node
-
     # Selecting the corresponding edge
-    edge_id = [node_id_start, node_id_end] # Corresponding edge ID
-    try: # To deal with one-way streets
-        edge = network['edges'].loc[(node_id_start, node_id_end)] # Get coordinates of the points that make up that edge
-        edge_coords = get_single_edge_coords(network, [node_id_start, node_id_end])
-    except:
-        edge = network['edges'].loc[(node_id_end, node_id_start)] # Get coordinates of the points that make up that edge
-        edge_coords = edge_to_coords(network_edges, [node_id_end, node_id_start])
-        edge_coords = edge_coords[::-1]
+    edge_table = network['edge_table']
+    row, flip = edge_table['index'][(node_id_start, node_id_end)]
+    edge_coords = get_edge_coords(edge_table, node_id_start, node_id_end)
 
-    # Filling the segment_list_raw list
-    segment_list = []
-#     print(f'No of points in edge: {len(edge_coords)}')
-    for j in range(0,len(edge_coords)-1): # Loop over all vertex pairs in the edge        
-        x0 = edge_coords[j][0]
-        y0 = edge_coords[j][1]
-        x1 = edge_coords[j+1][0]
-        y1 = edge_coords[j+1][1]
-        d_cart = cartesian_distance(x0,y0,x1,y1)
-        d_osm = edge['length'][0]/(len(edge_coords)-1) # just divide the length equally between segments
-        highway = edge['highway'][0]
-        surface = np.nan
-        tracktype = np.nan
-        if 'surface' in edge.columns:
-            surface = edge['surface'][0]
-        if 'tracktype' in edge.columns:
-            tracktype = edge['tracktype'][0]
-        segment_list.append([x0,y0,x1,y1,d_cart,d_osm,highway,surface,tracktype])
-    
-#     print(f'Length of segment_list inside get_seg: {len(segment_list)}')
-    return segment_list
+    # Filling the segment_list, one segment for each vertex pair in the edge
+    n = len(edge_coords) - 1
+    x0 = edge_coords[:-1,0]
+    y0 = edge_coords[:-1,1]
+    x1 = edge_coords[1:,0]
+    y1 = edge_coords[1:,1]
+    d_cart = cartesian_distance(x0,y0,x1,y1)
+    d_osm = edge_table['length'][row]/n # just divide the length equally between segments
+    highway = edge_table['highway'][row]
+    surface = edge_table['surface'][row]
+    tracktype = edge_table['tracktype'][row]
+    
+    return [[x0[j],y0[j],x1[j],y1[j],d_cart[j],d_osm,highway,surface,tracktype] for j in range(n)]
     
 # Main map matching algorithm, may want to split this up more
 # Trail coords is a list of [lat, lon] pairs
-def match_roads(network,trail_coords):
+def match_roads(network,trail_coords,route_cache=None):
     warnings.filterwarnings("ignore", category=UserWarning) # TODO: Figure out projection issue so this warning is not thrown
     
     # --- MAPPING GPX POINT TO EDGE ENDS --- #
@@ -201,13 +457,14 @@ def match_roads(network,trail_coords):
         k += 1 # Increment iteration counter
     print('')
     node_list = remove_successive_duplicates(node_list_raw) # Because # trail_point may map to the same nearest_edge_end
+    network = prepare_trees(network, zip(node_list[:-1], node_list[1:])) # One search per node serves both directions
     
     # --- PERFORM PATHFINDING BETWEEN THE NODES IN NODE_LIST --- #
     route_list_raw = [] # Contains IDs of all nodes that make up the shortest route between the nodes in node_list
     for i in range(0,len(node_list)-1):
 #         print_overwrite(f'\r   Handling node_list pair {i} of {len(node_list)-2}...')
         print(f'   Handling node_list pair {i} of {len(node_list)-2}...')
-        route_list_raw.extend(get_shortest_route(network, node_list[i], node_list[i+1]))
+        route_list_raw.extend(get_shortest_route(network, node_list[i], node_list[i+1], route_cache))
     print('')
     route_list = remove_successive_duplicates(route_list_raw)
     
@@ -251,29 +508,19 @@ def match_nodes_vec(network,trail_coords):
     warnings.filterwarnings("ignore", category=UserWarning) # TODO: Figure out projection issue so this warning is not thrown
     
     # --- MAPPING GPX POINT TO EDGE ENDS --- #
-    k = 0 # Iteration counter
-    node_list_raw = [] # Will contain the nodes between which pathfinding should take place
-    
     first = [point[1] for point in trail_coords]
     second = [point[0] for point in trail_coords]
     nearest_edges = ox.distance.nearest_edges(network['graph'],first,second)
     
-    for j in range(len(trail_coords)):
-#         print_overwrite(f'\r   Handling GPX point {k} of {len(trail_coords)-1}...')
-        nearest_edge_end = get_nearest_edge_end(network,
-                                                nearest_edges[j],
-                                                trail_coords[j]) # ID of the edge end node that trail_point is closest to
-        node_list_raw.append(nearest_edge_end) # Add it to the list
-        k += 1 # Increment iteration counter
-    print('')
+    node_list_raw = get_nearest_edge_ends(network, nearest_edges, trail_coords).tolist() # IDs of the edge end nodes closest to each point
     
     return node_list_raw
 
-def match_batch(trail_section, trail_coords, delta):
+def match_batch(trail_section, trail_coords, delta, store=None, route_cache=None, fetcher=None):
     
     lat_min, lat_max, lon_min, lon_max = get_bbox(trail_section,delta) # Calculate the bounding box
-    network = get_osm_network(lat_min, lat_max, lon_min, lon_max) # Download the street network from OSM
-    segment_list = match_roads(network, trail_coords) # Get the corresponding OSM segments
+    network = get_osm_network(lat_min, lat_max, lon_min, lon_max, store, fetcher) # Download the street network from OSM
+    segment_list = match_roads(network, trail_coords, route_cache) # Get the corresponding OSM segments
     
     return network, segment_list
     
@@ -303,29 +550,58 @@ def remove_repeat_segments(data_roads):
 
     return data_roads_filtered
 
-def trail2roads(trailname, trail, points_per_batch, delta):
+# With a stage_cache the batches are stored under a key of their GPX points and settings, see gr_stagecache
+# With workers>1 the batches are matched in parallel, each worker writes its own batch files (see gr_parallel)
+# With a fetcher the networks of the next batches are downloaded while a batch is matched (only with workers=1)
+# Returns the filenames of the batches, to be merged by gr_utils.merge_roads
+def trail2roads(trailname, trail, points_per_batch, delta, store=None, route_cache=None, stage_cache=None, workers=1,
+                fetcher=None):
     
     # Matching GPX track to OSM network (uses _osm_network_download under the hood)
     n_trail = len(trail) # Number of GPX points in the trail
     n_batch = int(np.ceil(trail.shape[0]/points_per_batch)) # Number of batches to be run
+    if workers!=1: # The route cache and the fetcher are not shared between processes
+        store = gr_parallel.get_worker_store(store)
+        route_cache = None
+        fetcher = None
+    batch_files = []
+    tasks = []
     for b in range(n_batch): # Using batch counter b
 
         # Define the range of GPX points to process in the current batch
         n1 = b*points_per_batch # First point of this batch
         n2 = min(n1 + points_per_batch, n_trail) # Last point of this batch (clipped)
         trail_section = trail.loc[n1:n2] # Select that range of GPX points
-        trail_coords  = trail_to_coords(trail_section) # Convert the points into a list of [lat, lon] pairs
 
         # Check if this batch was processed before
-        batch_out = f'cache/{trailname}_roads_{n1}to{n2}.csv'
-        print(f'Handling {b} of {n_batch-1} that covers GPX track points {n1} through {n2}...')
-        if os.path.isfile(batch_out): # It already exists
-            print('   This batch was processed before, skipping.')
+        if stage_cache is None:
+            batch_out = f'cache/{trailname}_roads_{n1}to{n2}'
+        else:
+            params = {'delta':delta, 'store':gr_stagecache.get_store_version(store)}
+            batch_out = gr_stagecache.get_batch_filename(stage_cache, trailname, 'roads', params, trail_section)
+        batch_files.append(batch_out)
+        if gr_storage.stage_exists(batch_out): # It already exists
+            print(f'Batch {b} of {n_batch-1} that covers GPX track points {n1} through {n2} was processed before, skipping.')
         else: # It does not exist, so process it
-            network, segment_list = match_batch(trail_section, trail_coords, delta)
-            gr_utils.write_batch(batch_out, segment_list)
-            print('   Finished this batch.')
-            print('')
+            tasks.append((b, n_batch, trail_section, delta, store, route_cache, batch_out))
+
+    # Networks of the batches that follow each batch
+    bboxes = [get_bbox(task[2], delta) for task in tasks]
+    tasks = [task + (fetcher, bboxes[t+1:]) for t, task in enumerate(tasks)]
+    gr_parallel.run_batches(match_batch_to_file, tasks, workers)
+
+    return batch_files
+
+# Matches the GPX points of a single batch to roads and writes the segments to batch_out
+def match_batch_to_file(b, n_batch, trail_section, delta, store, route_cache, batch_out, fetcher=None, next_bboxes=()):
+    
+    print(f'Handling {b} of {n_batch-1} that covers GPX track points {trail_section.index[0]} through {trail_section.index[-1]}...')
+    prefetch_networks(fetcher, next_bboxes, store)
+    trail_coords  = trail_to_coords(trail_section) # Convert the points into a list of [lat, lon] pairs
+    network, segment_list = match_batch(trail_section, trail_coords, delta, store, route_cache, fetcher)
+    gr_utils.write_batch(batch_out, segment_list)
+    print('   Finished this batch.')
+    print('')
             
 def get_dist(X,Y):
     r = [X[0] - Y[0],
@@ -359,11 +635,33 @@ def get_coords_from_route(route):
     return xy
 
 def get_path_error(route,trail_coords):
-    xy = get_coords_from_route(route)
-    err = 0
-    for point in trail_coords: # for each point from the gpx
-        dmin = 999
-        for j in range(len(xy)-1): # find the min distance to the pathfind
-            dmin = min(dmin,get_p2seg_distance(point,xy[j],xy[j+1]))
-        err += dmin*dmin # save the squared error
-    return err
\ No newline at end of file
+    
+    return get_path_errors([route],trail_coords)[0]
+
+# Sum of squared distances between the GPX points and each route, for all candidate routes of a piece at once
+# The points are handled in chunks so the distance matrix stays below max_elements entries
+def get_path_errors(routes,trail_coords,max_elements=1000000):
+    
+    # Stack the segments of all routes, keeping track of where each route starts
+    P0 = []
+    P1 = []
+    starts = []
+    nseg = 0
+    for route in routes:
+        xy = np.array(get_coords_from_route(route))
+        P0.append(xy[:-1])
+        P1.append(xy[1:])
+        starts.append(nseg)
+        nseg += len(xy) - 1
+    P0 = np.concatenate(P0)
+    P1 = np.concatenate(P1)
+    
+    points = np.array(trail_coords, dtype=float).reshape(-1,2)
+    chunksize = max(1, max_elements//nseg)
+    dmin = np.zeros((points.shape[0]+1, len(routes))) # First row stays zero, it is the start of the sum
+    for c in range(0, points.shape[0], chunksize):
+        d = gr_utils.get_p2seg_distances(points[c:c+chunksize], P0, P1)
+        dmin[c+1:c+1+chunksize] = np.minimum(np.minimum.reduceat(d, starts, axis=1), 999) # min distance to each pathfind
+    
+    err = np.cumsum(dmin*dmin, axis=0)[-1] # save the squared error, summed in the same order as a plain loop
+    return err.tolist()
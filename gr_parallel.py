@@ -0,0 +1,60 @@
+import time
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Spreads independent batches (each builds its own bbox network) over a pool of worker processes.
+# The results are returned in batch order, so stitching them together gives the same output as a serial run.
+
+# Returns the number of workers to use, None uses all cores
+def get_workers(workers):
+
+    return os.cpu_count() if workers is None else max(int(workers), 1)
+
+# Returns a copy of a graph store that can be sent to a worker, without the tiles held in memory
+# Online stores download and write tiles from several workers at once, use a store built with
+# gr_graphstore.build_store (or a warmed-up online store) for parallel runs
+def get_worker_store(store):
+
+    return None if store is None else dict(store, memory={}, tiles=set(store['tiles']))
+
+def timed_call(function, args):
+
+    t0 = time.time()
+    result = function(*args)
+    return result, time.time() - t0, os.getpid()
+
+# Calls function(*args) for every args in tasks, on workers processes (workers=1 runs in this process)
+# Returns the results in the order of tasks and prints the time spent on every batch
+def run_batches(function, tasks, workers=1, label='batch'):
+
+    workers = get_workers(workers)
+    results = [None]*len(tasks)
+    timings = [0.0]*len(tasks)
+    t0 = time.time()
+
+    if workers==1 or len(tasks)<2:
+        for b, args in enumerate(tasks):
+            results[b], timings[b], pid = timed_call(function, args)
+    else:
+        print(f'Running {len(tasks)} {get_plural(label)} on {workers} workers...')
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(timed_call, function, args):b for b, args in enumerate(tasks)}
+            for future in as_completed(futures):
+                b = futures[future]
+                results[b], timings[b], pid = future.result()
+                print(f'   Finished {label} {b} in {timings[b]:.1f} s (worker {pid})')
+
+    print_timings(timings, time.time() - t0, workers, label)
+    return results
+
+def get_plural(label):
+
+    return label + ('es' if label.endswith(('ch','sh','s','x')) else 's')
+
+def print_timings(timings, wall_time, workers, label):
+
+    if len(timings)==0:
+        return
+    total = sum(timings)
+    print(f'{len(timings)} {get_plural(label)} took {total:.1f} s of batch time in {wall_time:.1f} s wall time on {workers} worker(s) '
+          f'(slowest {max(timings):.1f} s, mean {total/len(timings):.1f} s, speedup {total/max(wall_time, 1e-9):.1f}x)')
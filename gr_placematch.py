@@ -2,7 +2,12 @@ import shapely
 import osmnx  as ox
 import numpy as np
 import os.path
+from osmnx._errors import InsufficientResponseError
 import gr_utils
+import gr_storage # Contains the typed storage of the pipeline stage outputs
+import gr_stagecache # Contains the content-addressed cache of the pipeline stages
+import gr_fetch # Contains the background fetch layer for OSM downloads
+import gr_graphstore # Contains the tiled on-disk store of OSM street networks, whose tile grid is reused here
 
 def is_polygon(row):
     
@@ -19,125 +24,245 @@ def get_bbox(data_roads_section, delta):
     lon_max = data_roads_section['y1'].max() + delta
     return ox.utils_geo.bbox_to_poly(lat_max, lat_min, lon_max, lon_min) # polygon of bbox around subset
 
-def get_places(bbox):
-    
-    # Downloading places information
-    tags = {"landuse": ['commercial','construction','education','industrial',
-                        'residential','retail','institutional','farmyard','cemetery',
-                        'garages','railway','landfill','brownfield','quarry','military'],
-            "admin_level": True
-           }
-    places = ox.geometries_from_polygon(bbox, tags)
+# Landuse values that count as development
+landuse_types = ['commercial','construction','education','industrial',
+                 'residential','retail','institutional','farmyard','cemetery',
+                 'garages','railway','landfill','brownfield','quarry','military']
+
+# Filtering places with landuse that have a polygon or multipolygon
+def filter_landuse_places(places):
     
-    # Filtering places with landuse that have a polygon or multipolygon
     mask_landuse = places['landuse'].notna()
     places_landuse_raw = places[mask_landuse]
     mask_polygon = (places_landuse_raw.apply(is_polygon, axis=1))==True
-    places_landuse = places_landuse_raw[mask_polygon] 
+    return places_landuse_raw[mask_polygon] 
 
-    # Filtering places with admin_level 8 or 9
+# Filtering places with admin_level 8 or 9
+def filter_admin_places(places):
+    
     mask_admin8 = places['admin_level']=="8" # True if it has admin_level = 8
     mask_admin9 = places['admin_level']=="9" # True if it has admin_level = 9
-    places_admin8 = places[mask_admin8]
-    places_admin9 = places[mask_admin9]
+    return places[mask_admin8], places[mask_admin9]
+
+def get_places(bbox):
+    
+    # Downloading places information
+    tags = {"landuse": landuse_types,
+            "admin_level": True
+           }
+    places = ox.geometries_from_polygon(bbox, tags)
+    
+    places_landuse = filter_landuse_places(places)
+    places_admin8, places_admin9 = filter_admin_places(places)
        
     # Return places
     return places_landuse, places_admin8, places_admin9
 
+# Downloads only the admin level 8 and 9 places, for when the landuse places come from a landuse cache
+def get_admin_places(bbox):
+    
+    places = ox.geometries_from_polygon(bbox, {"admin_level": True})
+    return filter_admin_places(places)
+
 def get_all_places(bbox):
     
     # Downloading places information
     tags = {"landuse": True}
     places = ox.geometries_from_polygon(bbox, tags)
     
-    # Filtering places with landuse that have a polygon or multipolygon
-    mask_landuse = places['landuse'].notna()
-    places_landuse_raw = places[mask_landuse]
-    mask_polygon = (places_landuse_raw.apply(is_polygon, axis=1))==True
-    places_landuse = places_landuse_raw[mask_polygon] 
-
     # Return places
-    return places_landuse
+    return filter_landuse_places(places)
 
-def get_place_info(data_section, places_landuse_merged, places_admin8, places_admin9):
+# Distance from each point to the nearest development polygon (x1000), 999.9 if there is none
+def get_dev_distances(points, tree):
     
-    d_vec = []
-    city8_vec = []
-    city9_vec = []
+    d = np.full(len(points), 999.9)
+    (point_idx, tree_idx), dist = tree.query_nearest(points, return_distance=True, all_matches=False)
+    d[point_idx] = np.minimum(d[point_idx], 1000*dist)
+    return d
+
+# Name of the first admin area that contains each point, 'none' if there is none
+def get_city_names(points, places_admin):
     
-    for i, segment in data_section.iterrows():
+    names = np.full(len(points), 'none', dtype=object)
+    tree = shapely.STRtree(places_admin['geometry'].values)
+    point_idx, tree_idx = tree.query(points, predicate='within')
+    if len(point_idx)==0:
+        return names
+    order = np.lexsort((tree_idx, point_idx)) # First admin area in frame order for every point
+    point_idx = point_idx[order]
+    tree_idx = tree_idx[order]
+    first = np.flatnonzero(np.diff(point_idx, prepend=-1)!=0)
+    names[point_idx[first]] = places_admin['name'].values[tree_idx[first]]
+    return names
 
-        xmid = (segment['x0'] + segment['x1'])/2
-        ymid = (segment['y0'] + segment['y1'])/2
-        point = shapely.geometry.Point(ymid,xmid) # We work with the midpoint of the segment
-        
-        # Calculating distance to development
-        d = 999.9;
-        for place in places_landuse_merged:
-            new_d = 1000*place.distance(point) # Calculate distance midpoint - polygon
-            d = min(d, new_d)
-        d_vec.append(d)
-   
-        # Check if the segment midpoint lies in any admin level 8 regions
-        city8 = 'none'
-        for j, place in places_admin8.iterrows():
-            if point.within(place['geometry']):
-                city8 = place['name']
-                break
-        city8_vec.append(city8)
-
-        # Check if the segment midpoint lies in any admin level 9 regions
-        city9 = 'none'
-        for j, place in places_admin9.iterrows():
-            if point.within(place['geometry']):
-                city9 = place['name']
-                break
-        city9_vec.append(city9)
+# Midpoints of the road segments as (lon, lat) points
+def get_midpoints(data_section):
+    
+    xmid = (data_section['x0'].values + data_section['x1'].values)/2
+    ymid = (data_section['y0'].values + data_section['y1'].values)/2
+    return shapely.points(ymid, xmid)
+
+# Returns arrays with the distance to development and the admin level 8/9 names of each segment midpoint
+def get_place_info(data_section, landuse_tree, places_admin8, places_admin9):
+    
+    points = get_midpoints(data_section) # We work with the midpoint of the segment
+    
+    # Calculating distance to development
+    d_vec = get_dev_distances(points, landuse_tree)
+    
+    # Check if the segment midpoints lie in any admin level 8 or 9 regions
+    city8_vec = get_city_names(points, places_admin8)
+    city9_vec = get_city_names(points, places_admin9)
     
     return d_vec, city8_vec, city9_vec
 
 def merge_landuse_places(places_landuse, buffersize, tol_area):
     
-    polys = []
+    polys = shapely.buffer(places_landuse['geometry'].values, buffersize) # Buffer all polygons
+    merged_polys = shapely.get_parts(shapely.unary_union(polys)) # Single polygons of the union
+    return [poly for poly in merged_polys if poly.area>tol_area]
+
+########################################
+## --- Cached merged landuse layer --- ##
+########################################
+
+# The merged landuse polygons only depend on the region, so they are computed once per tile of a grid (like the tiles
+# of gr_graphstore) and stored as WKB. Each tile is merged from the landuse places within the tile plus a margin, so
+# that polygons crossing the tile border are merged like they would be for a batch bbox.
+
+# Opens a landuse cache, tiles that were not merged before are downloaded from OSM when first needed
+def open_landuse_cache(cache_path='cache/landuse', tile_size=0.05, margin=0.01):
+    
+    os.makedirs(cache_path, exist_ok=True)
+    return {'path':cache_path, 'tile_size':tile_size, 'margin':margin, 'memory':{}}
+
+# The tile grid is part of the filename, so caches opened with another tile_size or margin never read these tiles
+def get_landuse_filename(cache, key, buffersize, tol_area):
+    
+    return os.path.join(cache['path'], f'landuse_{cache["tile_size"]}_{cache["margin"]}_{key[0]}_{key[1]}_{buffersize}_{tol_area}.wkb')
+
+# Returns the merged landuse polygons of a single tile from memory, from disk, or from OSM
+def get_landuse_tile(cache, key, buffersize, tol_area):
     
-    for i in range(places_landuse.shape[0]):
-        poly = places_landuse.iloc[i]['geometry'] # Grab polygon
-        poly = poly.buffer(buffersize) # Buffer it
-        polys.append(poly)
-    merged_polys = list(shapely.ops.unary_union(polys))
-        
-    large_polys = []
-    for poly in merged_polys:
-#         print(f'This poly as an area of {poly.area} vs. tol area of {tol_area}')
-        if poly.area>tol_area:
-            large_polys.append(poly)
-#             print('Including it')
-#         else:
-#             print('Excluding it')
-            
-        
-    return large_polys
+    memory_key = (key, buffersize, tol_area)
+    if memory_key in cache['memory']:
+        return cache['memory'][memory_key]
+    
+    filename = get_landuse_filename(cache, key, buffersize, tol_area)
+    if os.path.isfile(filename):
+        with open(filename, 'rb') as file:
+            polys = list(shapely.get_parts(shapely.from_wkb(file.read())))
+    else:
+        lat_min, lat_max, lon_min, lon_max = gr_graphstore.get_tile_bbox(key, cache['tile_size'])
+        m = cache['margin']
+        bbox = ox.utils_geo.bbox_to_poly(lat_max + m, lat_min - m, lon_max + m, lon_min - m)
+        try:
+            places = ox.geometries_from_polygon(bbox, {"landuse": landuse_types})
+            polys = merge_landuse_places(filter_landuse_places(places), buffersize, tol_area)
+        except InsufficientResponseError: # No landuse places inside this tile, failed requests raise and are not stored
+            polys = []
+        with open(f'{filename}.{os.getpid()}', 'wb') as file: # Renamed once written, as several processes may share the cache
+            file.write(shapely.to_wkb(shapely.geometrycollections(polys)))
+        os.replace(f'{filename}.{os.getpid()}', filename)
+    
+    cache['memory'][memory_key] = polys
+    return polys
+
+# Returns the merged landuse polygons of all tiles that overlap with a (lon, lat) polygon
+def get_landuse_merged(cache, bbox, buffersize, tol_area):
+    
+    lon_min, lat_min, lon_max, lat_max = bbox.bounds
+    polys = {}
+    for key in gr_graphstore.get_tile_keys(lat_min, lat_max, lon_min, lon_max, cache['tile_size']):
+        for poly in get_landuse_tile(cache, key, buffersize, tol_area):
+            polys.setdefault(poly.wkb, poly) # Polygons merged identically in neighbouring tiles are kept once
+    return list(polys.values())
+
+###################################
+## --- Corridor places layer --- ##
+###################################
+
+# Returns the polygon of the corridor around all road segments, in (lon, lat) coordinates
+def get_corridor(data_roads, delta):
+    
+    lat = np.append(data_roads['x0'].values, data_roads['x1'].values[-1])
+    lon = np.append(data_roads['y0'].values, data_roads['y1'].values[-1])
+    return shapely.linestrings(lon, lat).buffer(delta)
 
-def add_places(data_roads, delta, buffersize, tol_area, n1, n2):
+# Loads the landuse and admin places of the corridor around the whole trail at once, from OSM or from a local .osm
+# extract, and merges the landuse places once. Every batch is then served from this in-memory layer.
+def get_places_layer(data_roads, delta, buffersize, tol_area, filename_osm=None):
+    
+    corridor = get_corridor(data_roads, delta)
+    tags = {"landuse": landuse_types,
+            "admin_level": True
+           }
+    if filename_osm is None:
+        places = ox.geometries_from_polygon(corridor, tags)
+    else:
+        places = ox.geometries_from_xml(filename_osm, polygon=corridor, tags=tags)
+    
+    places_landuse_merged = merge_landuse_places(filter_landuse_places(places), buffersize, tol_area)
+    places_admin8, places_admin9 = filter_admin_places(places)
+    return {'corridor':corridor, 'landuse_tree':shapely.STRtree(places_landuse_merged),
+            'admin8':places_admin8, 'admin9':places_admin9}
+
+# Returns function(bbox) for one of the place download functions, through the fetcher if one is given (see gr_fetch)
+def fetch_places(fetcher, function, bbox):
+    
+    if fetcher is None:
+        return function(bbox)
+    return gr_fetch.fetch(fetcher, (function.__name__,) + bbox.bounds, function, bbox)
+
+# Starts downloading the places of the upcoming batches in the background
+def prefetch_places(fetcher, function, bboxes):
+    
+    for bbox in bboxes[:fetcher['lookahead']]:
+        gr_fetch.prefetch(fetcher, (function.__name__,) + bbox.bounds, function, bbox)
+
+def add_places(data_roads, delta, buffersize, tol_area, n1, n2, landuse_cache=None, places_layer=None, fetcher=None):
 
     # Collect place data from OSM
     bbox = get_bbox(data_roads.loc[n1:n2], delta) # Polygon of bounding box around section
-    places_landuse, places_admin8, places_admin9 = get_places(bbox) # Grab relevant place information
-#     print(f'There are {places_landuse.shape[0]} uncorrected landuse places')
+    if places_layer is not None: # Everything was loaded for the whole corridor
+        landuse_tree = places_layer['landuse_tree']
+        places_admin8 = places_layer['admin8']
+        places_admin9 = places_layer['admin9']
+    elif landuse_cache is None:
+        places_landuse, places_admin8, places_admin9 = fetch_places(fetcher, get_places, bbox) # Grab relevant place information
+#         print(f'There are {places_landuse.shape[0]} uncorrected landuse places')
     
-    # Merge landuse places into larger polys
-    places_landuse_merged = merge_landuse_places(places_landuse, buffersize, tol_area)
-#     print(f'There are {len(places_landuse_merged)} corrected landuse places')
+        # Merge landuse places into larger polys
+        places_landuse_merged = merge_landuse_places(places_landuse, buffersize, tol_area)
+#         print(f'There are {len(places_landuse_merged)} corrected landuse places')
+        landuse_tree = shapely.STRtree(places_landuse_merged)
+    else:
+        places_admin8, places_admin9 = fetch_places(fetcher, get_admin_places, bbox) # Grab the admin places only
+        places_landuse_merged = get_landuse_merged(landuse_cache, bbox, buffersize, tol_area) # Merged once per tile
+        landuse_tree = shapely.STRtree(places_landuse_merged)
     
     # Get development distance & city names
-    d_vec, city8_vec, city9_vec = get_place_info(data_roads.loc[n1:n2], places_landuse_merged, places_admin8, places_admin9)
+    d_vec, city8_vec, city9_vec = get_place_info(data_roads.loc[n1:n2], landuse_tree, places_admin8, places_admin9)
     data_roads.loc[n1:n2,'dev_dist'] = d_vec
     data_roads.loc[n1:n2,'city8'] = city8_vec
     data_roads.loc[n1:n2,'city9'] = city9_vec
     
     return data_roads
 
-def roads2places(trailname,data_roads,points_per_batch_places, delta_places, buffersize, tol_area):
+# Returns the settings that decide how the places are loaded and merged, to be part of the stage and batch cache keys
+# Corridor places, per tile merged landuse (which depends on the tiling) and per batch merged landuse give different results
+def get_places_mode(landuse_cache=None, corridor=False, filename_osm=None):
+    
+    landuse = None if landuse_cache is None else {'tile_size':landuse_cache['tile_size'], 'margin':landuse_cache['margin']}
+    return {'corridor':bool(corridor), 'landuse_cache':landuse, 'osm':filename_osm or 'overpass'}
+
+# With corridor=True the places of the whole trail corridor are loaded once (from filename_osm if given) instead of per batch
+# With a stage_cache the batches are stored under a key of their segments and settings, see gr_stagecache
+# With a fetcher the places of the next batches are downloaded while a batch is matched
+# Returns the filenames of the batches, to be merged by gr_utils.merge_places
+def roads2places(trailname,data_roads,points_per_batch_places, delta_places, buffersize, tol_area, landuse_cache=None,
+                 corridor=False, filename_osm=None, stage_cache=None, fetcher=None):
     
     ## Matching GPX track to OSM places (uses _osm_place_download under the hood)
     n_roads = len(data_roads) # Number of segments in data_roads
@@ -146,6 +271,12 @@ def roads2places(trailname,data_roads,points_per_batch_places, delta_places, buf
     data_roads['dev_dist'] = 0.0 # filling
     data_roads['city8'] = ''
     data_roads['city9'] = ''
+    places_layer = None # Corridor places, loaded when the first batch needs them
+    road_columns = [column for column in data_roads.columns if column in gr_storage.segment_columns]
+    params = {'delta_places':delta_places, 'buffersize':buffersize, 'tol_area':tol_area,
+              **get_places_mode(landuse_cache, corridor, filename_osm)}
+    batch_files = []
+    batches = []
     
     for b in range(n_batch_places): # Using batch counter b
 
@@ -154,13 +285,34 @@ def roads2places(trailname,data_roads,points_per_batch_places, delta_places, buf
         n2 = min(n1 + points_per_batch_places, n_roads) - 1 # Last point of this batch (clipped)
 
         # Check if this batch was processed before
-        batch_out = f'cache/{trailname}_places_{n1}to{n2}.csv'
+        if stage_cache is None:
+            batch_out = f'cache/{trailname}_places_{n1}to{n2}'
+        else:
+            batch_out = gr_stagecache.get_batch_filename(stage_cache, trailname, 'places', params, data_roads.loc[n1:n2, road_columns])
+        batch_files.append(batch_out)
+        batches.append((b, n1, n2, batch_out))
+    
+    # Batches that still need their places, in the order they are processed
+    pending = [(n1, n2) for b, n1, n2, batch_out in batches if not gr_storage.stage_exists(batch_out)]
+    fetch_function = get_places if landuse_cache is None else get_admin_places
+    
+    for b, n1, n2, batch_out in batches:
+        
         print(f'Handling batch {b} of {n_batch_places-1} that covers road segments {n1} through {n2}...')
         
-        if os.path.isfile(batch_out): # It already exists
+        if gr_storage.stage_exists(batch_out): # It already exists
             print('   This batch was processed before, skipping.')
         
         else: # It does not exist, so process it (use loc to avoid selection error)
-            data_roads = add_places(data_roads, delta_places, buffersize, tol_area, n1, n2)
+            if corridor and places_layer is None:
+                print('   Loading the places of the whole trail corridor...')
+                places_layer = get_places_layer(data_roads, delta_places, buffersize, tol_area, filename_osm)
+            elif not corridor and fetcher is not None: # Download the places of the next batches meanwhile
+                p = pending.index((n1, n2))
+                next_bboxes = [get_bbox(data_roads.loc[m1:m2], delta_places) for m1, m2 in pending[p+1:p+1+fetcher['lookahead']]]
+                prefetch_places(fetcher, fetch_function, next_bboxes)
+            data_roads = add_places(data_roads, delta_places, buffersize, tol_area, n1, n2, landuse_cache, places_layer, fetcher)
             gr_utils.write_batch_places(batch_out, data_roads.loc[n1:n2])
-            print('   Finished this batch.')
\ No newline at end of file
+            print('   Finished this batch.')
+
+    return batch_files
\ No newline at end of file
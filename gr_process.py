@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+import json
 
 def get_development_type(data,tol_d):
     
@@ -9,42 +10,26 @@ def get_development_type(data,tol_d):
     
     return data
 
+# Groups successive rows with the same development type
+# Each group also counts the distance of the first row of the next group, the last row is never part of a group
 def get_development_groups(data):
     
-    devgroups = pd.DataFrame()
-    k = 0 # group counter
-    n = data.shape[0] # nrows in data
-    j0 = 0
-    j1 = j0
-
-    while j1<n-1:
-
-        dev0 = data.loc[j0]['development']
-        j1 = j0 + 1
-        dev1 = data.loc[j1]['development']
-
-        # increment j1 until we find a different development type
-        while dev1==dev0:
-            if j1 == n-1: # we have reached the end of the data dataframe
-                break
-            j1 += 1
-            dev1 = data.loc[j1]['development']
-            
-        # calculate distance of covered by this group
-        d = 0
-        for j in range(j0,j1+1):
-            row = data.loc[j]
-            d += row['d1'] - row['d0']
-            
-        # add to devgroups list
-        newrow = pd.DataFrame({'dev':dev0, 'j0':j0, 'j1':j1-1, 'd':d},index={k})
-        devgroups = pd.concat([devgroups,newrow])
-        k += 1
-
-        # move to the next devgroup by setting j0 = j1
-        j0 = j1
-    
-    return devgroups
+    dev = data['development'].values
+    n = len(dev)
+    if n<2:
+        return pd.DataFrame(columns=['dev','j0','j1','d'])
+    
+    starts = np.concatenate(([0], np.flatnonzero(dev[1:]!=dev[:-1]) + 1)) # First row of every group
+    j1 = np.append(starts[1:], n-1) # First row of the next group
+    ngroups = np.flatnonzero(j1>=n-1)[0] + 1
+    starts = starts[:ngroups]
+    j1 = j1[:ngroups]
+    
+    # Distance covered by rows j0 up to and including j1
+    dd = data['d1'].values - data['d0'].values
+    d = np.add.reduceat(dd[:j1[-1]], starts) + dd[j1]
+    
+    return pd.DataFrame({'dev':dev[starts], 'j0':starts, 'j1':j1-1, 'd':d})
 
 def smooth_development_type(data, tol_d):
     
@@ -58,16 +43,6 @@ def smooth_development_type(data, tol_d):
     
     
     
-def get_traffic_type(data,types_slow,types_heavy):
-    
-    data['traffic'] = 1 # normal roads
-    mask_slow = data['highway'].isin(types_slow)
-    mask_heavy = data['highway'].isin(types_heavy)
-    data.loc[mask_slow,'traffic'] = 0 # slow roads
-    data.loc[mask_heavy,'traffic'] = 2 # heavy roads
-    
-    return data
-
 def grab_first(x):
     
     if x is not None:
@@ -78,93 +53,156 @@ def grab_first(x):
     
     return x
 
-def get_paved_type(data,tracktype_p0,tracktype_p1,tracktype_p2,surface_p0,surface_p1,highway_p1):
+# Converts a tag column to a categorical column, with "none" for missing tags
+def get_tag_column(column):
     
-    # Replacing nans
-    data['highway'] = data['highway'].replace({np.nan:"none"})
-    data['surface'] = data['surface'].replace({np.nan:"none"})
-    data['tracktype'] = data['tracktype'].replace({np.nan:"none"})
+    tags = pd.Categorical(column)
+    if 'none' not in tags.categories:
+        tags = tags.add_categories('none')
+    return tags.fillna('none')
+
+# Applies grab_first to every distinct tag only once, returns a categorical column
+def get_first(tags):
     
-    # Grabbing first one
-    data['first_highway'] = data['highway'].apply(grab_first)
-    data['first_surface'] = data['surface'].apply(grab_first)
-    data['first_tracktype'] = data['tracktype'].apply(grab_first)
-    
-    # Establishing status
-    data['paved'] = -1
-    this_paved = -1
-    for idx, row in data.iterrows():
-        if row['first_tracktype'] in tracktype_p0: # Unpaved tracktype
-            this_paved = 0
-        elif row['first_tracktype'] in tracktype_p1: # Semi-paved tracktype
-            this_paved = 1
-        elif row['first_tracktype'] in tracktype_p2: # Paved tracktype
-            this_paved = 2
-        else: # Empty tracktype
-            if row['first_surface'] in surface_p0: # Unpaved surface type
-                this_paved = 0
-            elif row['first_surface'] in surface_p1: # Semi-paved surface type
-                this_paved = 1
-            elif row['first_surface'] in ['none']: # Empty surface type
-                if row['first_highway'] in highway_p1: # Semi-paved highway type
-                    this_paved = 1
-                else: # Paved highway type
-                    this_paved = 2
-            else: # Paved surface type
-                this_paved = 2
-        
-        data.loc[idx,'paved'] = this_paved
-        
-    return data
+    first_codes, first_tags = pd.factorize(np.array([grab_first(x) for x in tags.categories], dtype=object))
+    return pd.Categorical.from_codes(first_codes[tags.codes], first_tags)
+
+##################################
+## --- Classification rules --- ##
+##################################
+
+# A rule set holds all criteria that turn the tags & development distance of a segment into its GR type. It is a dict
+# like the one below, which can be stored as a .json or .yaml file and loaded with load_rule_set:
+# {'name': 'default',
+#  'tol_d': 0.75,
+#  'paved': {'tracktype': {'unpaved': [...], 'semi_paved': [...], 'paved': [...]},
+#            'surface': {'unpaved': [...], 'semi_paved': [...]},
+#            'highway': {'semi_paved': [...]}},
+#  'traffic': {'slow': [...], 'heavy': [...]},
+#  'gr_types': {'light': [[1,1,4],[1,1,6],[3,3,3]], 'heavy': [[2,2,4],[2,2,5],[3,3,3]]}}
+# The gr_types matrices are indexed by [traffic][paved], light for undeveloped and heavy for developed segments.
+
+# Builds a rule set from the classic list settings of places2processed
+def make_rule_set(tol_d,types_slow,types_heavy,tracktype_p0,tracktype_p1,tracktype_p2,surface_p0,surface_p1,highway_p1,
+                  name='default'):
+    
+    return {'name':name,
+            'tol_d':tol_d,
+            'paved':{'tracktype':{'unpaved':tracktype_p0, 'semi_paved':tracktype_p1, 'paved':tracktype_p2},
+                     'surface':{'unpaved':surface_p0, 'semi_paved':surface_p1},
+                     'highway':{'semi_paved':highway_p1}},
+            'traffic':{'slow':types_slow, 'heavy':types_heavy},
+            'gr_types':{'light':[[1,1,4],[1,1,6],[3,3,3]], 'heavy':[[2,2,4],[2,2,5],[3,3,3]]}}
+
+# Loads a rule set from a .json or .yaml/.yml file
+def load_rule_set(filename):
+    
+    with open(filename) as file:
+        if filename.endswith('.yaml') or filename.endswith('.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('Reading .yaml rule sets requires the pyyaml package, or use a .json rule set.')
+            return yaml.safe_load(file)
+        return json.load(file)
+
+# Compiles a rule set into lookup tables from tag to code, so it can be applied to any number of segments at once
+# A tracktype code of -1 means "no decision, look at the surface", a surface code of -1 "look at the highway type"
+def compile_rule_set(rules):
+    
+    # Earlier lists take precedence, so they are written last
+    tracktype = {}
+    for code, key in [(2,'paved'), (1,'semi_paved'), (0,'unpaved')]:
+        tracktype.update({tag:code for tag in rules['paved']['tracktype'].get(key, [])})
+    surface = {'none':-1}
+    for code, key in [(1,'semi_paved'), (0,'unpaved')]:
+        surface.update({tag:code for tag in rules['paved']['surface'].get(key, [])})
+    highway = {tag:1 for tag in rules['paved']['highway'].get('semi_paved', [])}
+    traffic = {tag:0 for tag in rules['traffic'].get('slow', [])}
+    traffic.update({tag:2 for tag in rules['traffic'].get('heavy', [])})
+    
+    return {'name':rules.get('name', 'default'),
+            'tol_d':rules['tol_d'],
+            'tracktype':tracktype, # Default -1
+            'surface':surface, # Default 2, paved
+            'highway':highway, # Default 2, paved
+            'traffic':traffic, # Default 1, normal roads
+            'gr_types':np.array([rules['gr_types']['light'], rules['gr_types']['heavy']])} # [development][traffic][paved]
+
+# Looks up the code of every row of a categorical column, the table is only consulted once per distinct tag
+def lookup_codes(tags, table, default):
+    
+    codes = np.array([table.get(tag, default) for tag in tags.categories] + [default], dtype=int)
+    return codes[tags.codes] # Missing tags (code -1) get the default
 
-def row2type(row):
+# Prepares the tag columns that every rule set works on, this only has to be done once per segments frame
+def prepare_tags(data):
     
-    types_light = [[1,1,4],[1,1,6],[3,3,3]]
-    types_heavy = [[2,2,4],[2,2,5],[3,3,3]]
+    # Replacing nans
+    data['highway'] = get_tag_column(data['highway'])
+    data['surface'] = get_tag_column(data['surface'])
+    data['tracktype'] = get_tag_column(data['tracktype'])
     
-    if row['development']==0: # light
-        gr_type = types_light[row['traffic']][row['paved']]
-    else: # heavy
-        gr_type = types_heavy[row['traffic']][row['paved']]
+    # Grabbing first one
+    data['first_highway'] = get_first(data['highway'].values)
+    data['first_surface'] = get_first(data['surface'].values)
+    data['first_tracktype'] = get_first(data['tracktype'].values)
     
-    return gr_type
+    return data
 
-def get_gr_type(data):
+# Applies compiled rule sets to prepared segments, adding the paved/traffic/development/gr_type columns
+# With suffix=True the columns are named after the rule set (e.g. gr_type_default), so several rule sets can be compared
+def apply_rule_sets(data, compiled_rule_sets, suffix=True):
+    
+    for rules in compiled_rule_sets:
+        
+        # Establishing status, the tracktype takes precedence over the surface, the surface over the highway type
+        paved = lookup_codes(data['first_tracktype'].values, rules['tracktype'], -1)
+        surface = lookup_codes(data['first_surface'].values, rules['surface'], 2)
+        highway = lookup_codes(data['first_highway'].values, rules['highway'], 2)
+        paved = np.where(paved>=0, paved, np.where(surface>=0, surface, highway))
+        
+        traffic = lookup_codes(data['highway'].values, rules['traffic'], 1)
+        development = np.where(data['dev_dist'].values>rules['tol_d'], 0, 1) # 0 is undeveloped, 1 is developed
+        gr_type = rules['gr_types'][development, traffic, paved]
+        
+        end = '_' + rules['name'] if suffix else ''
+        data['paved' + end] = paved
+        data['traffic' + end] = traffic
+        data['development' + end] = development
+        data['gr_type' + end] = gr_type
     
-    data['gr_type'] = data.apply(row2type, axis=1)
     return data
 
-def get_city_name(row):
+# Classifies the segments with several rule sets in one pass, e.g. to compare versions of the GR criteria
+def classify(data, rule_sets):
     
-    if row['city8'] == 'none':
-        return row['city9']
-    return row['city8']
+    data = prepare_tags(data)
+    return apply_rule_sets(data, [compile_rule_set(rules) for rules in rule_sets])
 
-def places2processed(data,
-                     tol_d,
-                     types_slow,types_heavy,
-                     tracktype_p0,tracktype_p1,tracktype_p2,surface_p0,surface_p1,highway_p1):
-    
-    # Establish paved status
-    data = get_paved_type(data,tracktype_p0,tracktype_p1,tracktype_p2,surface_p0,surface_p1,highway_p1)
-    
-    # Establish traffic status
-    data = get_traffic_type(data,types_slow,types_heavy)
+# Determines the paved/traffic/development status & GR type of every segment with a (loaded, not compiled) rule set
+def rules2processed(data, rules):
     
-    # Establish development status
-    data = get_development_type(data,tol_d)
+    # Establish paved, traffic & development status and GR route type
+    data = prepare_tags(data)
+    data = apply_rule_sets(data, [compile_rule_set(rules)], suffix=False)
     
     # Smooth development status
 #     data['development_smooth'] = smooth_development_type(data,250.0)
     
-    # Establish GR route type
-    data = get_gr_type(data)
-    
     # Select city name from city8 & city9
-    data['city'] = data.apply(get_city_name,axis=1)
+    data['city'] = np.where(data['city8']=='none', data['city9'], data['city8'])
     
     return data
 
+def places2processed(data,
+                     tol_d,
+                     types_slow,types_heavy,
+                     tracktype_p0,tracktype_p1,tracktype_p2,surface_p0,surface_p1,highway_p1):
+    
+    rules = make_rule_set(tol_d,types_slow,types_heavy,tracktype_p0,tracktype_p1,tracktype_p2,surface_p0,surface_p1,highway_p1)
+    return rules2processed(data, rules)
+
 def calculate_cumulative_distances(data):
     
     data['d_cum'] = data['d_cart'].cumsum()
@@ -0,0 +1,145 @@
+import numpy  as np
+import hashlib
+import shelve
+import atexit
+import glob
+import dbm
+import os
+from collections import OrderedDict
+
+# Memo of path queries (shortest path, k shortest paths) with an in-memory LRU in front of an on-disk store.
+# Entries are keyed by the version of the network they were computed on, so they are never reused on a network whose
+# edges differ. Networks cut from a graph store (see gr_mapmatch.get_osm_network) are all parts of one regional graph:
+# an entry whose paths lie well inside the network it was computed on has the same answer on the whole store graph, so
+# it is keyed by the store version instead, and reused by the networks of other trails that hold its paths (see
+# gr_mapmatch.is_regional). This is what lets overlapping trails (e.g. gr122 and gr564) skip most of their routing.
+# Worker processes read the shared on-disk store and write their new entries to one of their own, which are merged into
+# the shared store once the workers are done (see merge_route_cache).
+
+# Returns a hash of the routing topology (node pairs, keys and lengths) of a network, used as its version
+def get_network_version(edges):
+
+    sha = hashlib.sha1()
+    for level in range(edges.index.nlevels):
+        sha.update(np.ascontiguousarray(edges.index.get_level_values(level).to_numpy(dtype=np.int64)).tobytes())
+    sha.update(np.ascontiguousarray(edges['length'].to_numpy(dtype=float)).tobytes())
+    return sha.hexdigest()[:16]
+
+# Opens a route cache, maxsize is the number of entries kept in memory
+# All network versions share one on-disk store, which is closed when the interpreter exits (or by close_route_cache)
+# With worker=True new entries are written to a store of this process, see merge_route_cache
+def open_route_cache(cache_path='cache/routes', maxsize=100000, worker=False):
+
+    os.makedirs(cache_path, exist_ok=True)
+    cache = {'path':cache_path, 'maxsize':maxsize, 'memory':OrderedDict(), 'worker':worker, 'shelf':None, 'shared':None,
+             'hits':0, 'misses':0}
+    atexit.register(close_route_cache, cache)
+    return cache
+
+def get_shelf_filename(cache_path, pid=None):
+
+    return os.path.join(cache_path, 'routes' if pid is None else f'routes_{pid}')
+
+# Returns the on-disk store that new entries are written to
+def get_shelf(cache):
+
+    if cache['shelf'] is None:
+        cache['shelf'] = shelve.open(get_shelf_filename(cache['path'], os.getpid() if cache['worker'] else None))
+    return cache['shelf']
+
+# Returns the shared on-disk store opened read-only, for worker caches only (None if it does not exist yet)
+def get_shared_shelf(cache):
+
+    if cache['worker'] and cache['shared'] is None and dbm.whichdb(get_shelf_filename(cache['path'])):
+        cache['shared'] = shelve.open(get_shelf_filename(cache['path']), flag='r')
+    return cache['shared']
+
+def get_shelf_key(key):
+
+    return ':'.join(str(item) for item in key)
+
+# Returns the key of a query on a network, shared entries are keyed by the version of the store it was cut from
+def get_key(network, query, shared=False):
+
+    return (network['region'] if shared else network['version'],) + query
+
+# Returns the entry of a key from memory or from disk, or None
+def find(cache, key):
+
+    if key in cache['memory']:
+        cache['memory'].move_to_end(key)
+        return cache['memory'][key]
+
+    shelf_key = get_shelf_key(key)
+    for shelf in (get_shelf(cache), get_shared_shelf(cache)):
+        if shelf is not None and shelf_key in shelf:
+            entry = shelf[shelf_key]
+            remember(cache, key, entry)
+            return entry
+    return None
+
+# Returns the cached entry of a query on a network, or None (counted as a miss) if it was not computed before
+# Entries of the store the network was cut from are only returned when check(entry) confirms the network holds them
+def lookup(cache, network, query, check=None):
+
+    entry = find(cache, get_key(network, query))
+    if entry is None and check is not None and 'region' in network:
+        entry = find(cache, get_key(network, query, shared=True))
+        if entry is not None and not check(entry):
+            entry = None
+
+    if entry is None:
+        cache['misses'] += 1
+    else:
+        cache['hits'] += 1
+    return entry
+
+# Stores (or updates) the entry of a query on a network, both in memory and on disk
+# With shared=True the entry is stored for every network of the store the network was cut from
+def store(cache, network, query, entry, shared=False):
+
+    key = get_key(network, query, shared)
+    remember(cache, key, entry)
+    get_shelf(cache)[get_shelf_key(key)] = entry
+
+# Adds an entry to the in-memory LRU, dropping the least recently used entries when it is full
+def remember(cache, key, entry):
+
+    cache['memory'][key] = entry
+    cache['memory'].move_to_end(key)
+    while len(cache['memory'])>cache['maxsize']:
+        cache['memory'].popitem(last=False)
+
+def print_stats(cache):
+
+    total = cache['hits'] + cache['misses']
+    rate = 100*cache['hits']/total if total>0 else 0
+    print(f'Route cache: {cache["hits"]} hits, {cache["misses"]} misses ({rate:.1f}% hit rate)')
+
+# Writes all pending entries to disk and closes the on-disk stores, the cache can still be used afterwards
+def close_route_cache(cache):
+
+    for name in ['shelf', 'shared']:
+        if cache[name] is not None:
+            cache[name].close()
+            cache[name] = None
+
+# Merges the stores written by worker caches into the shared store and removes them, returns the number of entries
+# Entries that are in both keep the one with the most paths
+def merge_route_cache(cache_path='cache/routes'):
+
+    filenames = sorted(set(os.path.splitext(filename)[0] for filename in glob.glob(get_shelf_filename(cache_path, '*') + '.*')))
+    n = 0
+    if len(filenames)==0:
+        return n
+    with shelve.open(get_shelf_filename(cache_path)) as shelf:
+        for filename in filenames:
+            with shelve.open(filename, flag='r') as worker_shelf:
+                for shelf_key in worker_shelf:
+                    entry = worker_shelf[shelf_key]
+                    if shelf_key not in shelf or len(entry.get('paths', ()))>=len(shelf[shelf_key].get('paths', ())):
+                        shelf[shelf_key] = entry
+                        n += 1
+            for part in glob.glob(filename + '.*'):
+                os.remove(part)
+    return n
@@ -0,0 +1,211 @@
+import osmnx  as ox
+import argparse
+import glob
+import time
+import os.path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import gr_mapmatch # Contains functions that perform the map matching of roads
+import gr_placematch # Contains functions that perform the map matching of places
+import gr_utils # Contains useful geometry functions
+import gr_process
+import roadmatch
+import gr_graphstore # Contains the tiled on-disk store of OSM street networks
+import gr_stagecache # Contains the content-addressed cache of the pipeline stages
+import gr_routecache # Contains the memo of path queries
+
+# Batch runner that processes a list of trails (by default every GPX file in data_input) on a pool of worker processes.
+# All trails share one graph store and one landuse cache: the tiles around every trail are loaded once up front, so
+# trails in the same area reuse them, and the worker processes inherit the loaded tiles. Paths that were searched for
+# one trail are reused by the overlapping trails through the route cache (see gr_routecache). The longest trails are
+# started first, so the catalog finishes when the cores run out of work rather than when the slowest trail ends.
+#
+#     python gr_runner.py gr131 gr5 --workers 8
+#     python gr_runner.py --workers 16 --store cache/graphstore_2024 # All trails after an OSM refresh
+
+# Same settings as main_new.ipynb
+default_settings = {'points_per_batch':100, 'delta_roads':0.010, 'min_dist_from_bbox':0.005, 'npaths':5, 'contract':False,
+                    'points_per_batch_places':100, 'delta_places':0.015, 'buffersize':0.00015, 'tol_area':15.0e-6,
+                    'rules':'data_input/gr_rules.json',
+                    'store':'cache/graphstore', 'landuse_cache':'cache/landuse', 'stage_cache':'cache/stages',
+                    'route_cache':'cache/routes'}
+
+# Graph store, landuse cache and route cache of this process, set by init_worker
+shared = {'store':None, 'landuse_cache':None, 'route_cache':None}
+
+ox.settings.useful_tags_way = [
+    "bridge","tunnel","name","highway","area","landuse","surface","tracktype"
+] # Configuring which parameters we want to obtain from OSM
+
+# Returns the names of all trails with a GPX file in data_input
+def list_trails(path='data_input'):
+
+    return sorted(os.path.splitext(os.path.basename(filename))[0] for filename in glob.glob(os.path.join(path, '*.gpx')))
+
+# Returns the keys of the tiles around the batches of a trail, delta is the tolerance around every batch bbox
+def get_trail_tile_keys(gpx, points_per_batch, delta, tile_size):
+
+    keys = set()
+    for n1 in range(0, len(gpx), points_per_batch):
+        lat_min, lat_max, lon_min, lon_max = gr_mapmatch.get_bbox(gpx.loc[n1:n1+points_per_batch], delta)
+        keys.update(gr_graphstore.get_tile_keys(lat_min, lat_max, lon_min, lon_max, tile_size))
+    return keys
+
+# Loads the street network and landuse tiles around all trails once, tiles shared by several trails are loaded once
+# Tiles that are still missing (e.g. when a batch retries with a larger bbox) are downloaded by the workers, the store and
+# the landuse cache write them atomically so workers can download at the same time
+def prefetch_tiles(gpxs, store, landuse_cache, settings):
+
+    graph_keys = {}
+    landuse_keys = {}
+    for trailname, gpx in gpxs.items():
+        for key in get_trail_tile_keys(gpx, settings['points_per_batch'], settings['delta_roads'], store['tile_size']):
+            graph_keys.setdefault(key, []).append(trailname)
+        # The road segments lie within the networks around the GPX points, so the place bboxes around the segments
+        # lie within delta_roads + delta_places of the GPX points
+        delta_segments = settings['delta_roads'] + settings['delta_places']
+        for key in get_trail_tile_keys(gpx, settings['points_per_batch'], delta_segments, landuse_cache['tile_size']):
+            landuse_keys.setdefault(key, []).append(trailname)
+
+    n_shared = sum(len(trailnames)>1 for trailnames in graph_keys.values())
+    print(f'Loading {len(graph_keys)} street network tiles ({n_shared} shared by several trails)...')
+    for key in sorted(graph_keys):
+        gr_graphstore.get_tile(store, key)
+
+    n_shared = sum(len(trailnames)>1 for trailnames in landuse_keys.values())
+    print(f'Loading {len(landuse_keys)} landuse tiles ({n_shared} shared by several trails)...')
+    for key in sorted(landuse_keys):
+        gr_placematch.get_landuse_tile(landuse_cache, key, settings['buffersize'], settings['tol_area'])
+
+# The route cache of a worker writes its new entries to a store of its own, merged by run_trails afterwards
+def init_worker(store, landuse_cache, route_cache_path):
+
+    shared['store'] = store
+    shared['landuse_cache'] = landuse_cache
+    shared['route_cache'] = gr_routecache.open_route_cache(route_cache_path, worker=True)
+
+# Runs all stages of a single trail like main_new.ipynb does, returns the time spent per stage [s]
+def run_trail(trailname, settings):
+
+    s = settings
+    store = shared['store']
+    landuse_cache = shared['landuse_cache']
+    route_cache = shared['route_cache']
+    stage_cache = gr_stagecache.open_stage_cache(s['stage_cache'])
+    rules = gr_process.load_rule_set(s['rules'])
+    timings = {}
+
+    t0 = time.time()
+    gpx = gr_utils.get_gpx(trailname)
+    gpx_coords = gr_mapmatch.trail_to_coords(gpx)
+    gpx_key = gr_stagecache.hash_data(gpx)
+    store_version = gr_stagecache.get_store_version(store)
+    timings['gpx'] = time.time() - t0
+
+    t0 = time.time()
+    params_nodes = {'points_per_batch':s['points_per_batch'], 'delta_roads':s['delta_roads'],
+                    'min_dist_from_bbox':s['min_dist_from_bbox'], 'store':store_version}
+    nodes, nodes_key = gr_stagecache.run_stage(stage_cache, trailname, 'nodes', params_nodes, [gpx_key],
+        lambda: roadmatch.gpx_to_nodes(gpx, gpx_coords, s['points_per_batch'], s['delta_roads'], s['min_dist_from_bbox'], store))
+    timings['nodes'] = time.time() - t0
+
+    t0 = time.time()
+    pieces, pieces_key = gr_stagecache.run_stage(stage_cache, trailname, 'pieces', {}, [nodes_key],
+        lambda: roadmatch.nodes_to_pieces(nodes))
+    timings['pieces'] = time.time() - t0
+
+    t0 = time.time()
+    params_segments = {'points_per_batch':s['points_per_batch'], 'delta_roads':s['delta_roads'], 'npaths':s['npaths'],
+                       'store':store_version, 'contract':s['contract']}
+    segments, segments_key = gr_stagecache.run_stage(stage_cache, trailname, 'roads', params_segments,
+        [gpx_key, nodes_key, pieces_key],
+        lambda: roadmatch.pieces_to_segments(gpx, nodes, s['points_per_batch'], s['delta_roads'], pieces, s['npaths'], store,
+                                             route_cache, contract=s['contract']))
+    gr_routecache.close_route_cache(route_cache) # Workers do not run exit handlers, the entries are written per trail
+    timings['roads'] = time.time() - t0
+
+    def get_places():
+        batch_files = gr_placematch.roads2places(trailname, segments.copy(), s['points_per_batch_places'], s['delta_places'],
+                                                 s['buffersize'], s['tol_area'], landuse_cache, stage_cache=stage_cache)
+        return gr_utils.merge_places(trailname, segments, s['points_per_batch_places'], batch_files=batch_files)
+
+    t0 = time.time()
+    params_places = {'delta_places':s['delta_places'], 'buffersize':s['buffersize'], 'tol_area':s['tol_area'],
+                     **gr_placematch.get_places_mode(landuse_cache)}
+    data_places, places_key = gr_stagecache.run_stage(stage_cache, trailname, 'places', params_places, [segments_key], get_places)
+    timings['places'] = time.time() - t0
+
+    def get_processed():
+        data_places2 = gr_mapmatch.remove_repeat_segments(data_places) # Remove backtracked sections
+        return gr_process.rules2processed(data_places2, rules)
+
+    t0 = time.time()
+    data, processed_key = gr_stagecache.run_stage(stage_cache, trailname, 'processed', {'rules':rules}, [places_key], get_processed)
+    gr_utils.write_processed(trailname, data)
+    timings['processed'] = time.time() - t0
+
+    return timings
+
+def print_summary(results, wall_time):
+
+    stages = ['gpx', 'nodes', 'pieces', 'roads', 'places', 'processed']
+    print('')
+    print(f'{"trail":<12}' + ''.join(f'{stage:>11}' for stage in stages) + f'{"total":>11}')
+    for trailname, timings in results.items():
+        if timings is None:
+            print(f'{trailname:<12}     failed')
+            continue
+        print(f'{trailname:<12}' + ''.join(f'{timings[stage]:>10.1f}s' for stage in stages) + f'{sum(timings.values()):>10.1f}s')
+    done = [timings for timings in results.values() if timings is not None]
+    total = sum(sum(timings.values()) for timings in done)
+    print(f'{"all":<12}' + ''.join(f'{sum(timings[stage] for timings in done):>10.1f}s' for stage in stages) + f'{total:>10.1f}s')
+    print(f'Processed {len(done)} of {len(results)} trails in {wall_time:.1f} s wall time ({total/max(wall_time, 1e-9):.1f}x)')
+
+# Processes a list of trails on workers processes (None uses all cores), returns the timings per trail and stage
+def run_trails(trailnames, workers=None, settings=None):
+
+    settings = {**default_settings, **(settings or {})}
+    workers = os.cpu_count() if workers is None else max(int(workers), 1)
+    t_start = time.time()
+
+    store = gr_graphstore.open_store(settings['store'])
+    landuse_cache = gr_placematch.open_landuse_cache(settings['landuse_cache'])
+    gpxs = {trailname:gr_utils.get_gpx(trailname) for trailname in trailnames}
+    prefetch_tiles(gpxs, store, landuse_cache, settings)
+
+    # Longest trails first
+    order = sorted(trailnames, key=lambda trailname: len(gpxs[trailname]), reverse=True)
+    results = {trailname:None for trailname in order}
+    print(f'Processing {len(order)} trails on {workers} workers...')
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(store, landuse_cache, settings['route_cache'])) as pool:
+        futures = {pool.submit(run_trail, trailname, settings):trailname for trailname in order}
+        for future in as_completed(futures):
+            trailname = futures[future]
+            try:
+                results[trailname] = future.result()
+                print(f'Finished trail {trailname} in {sum(results[trailname].values()):.1f} s')
+            except Exception as error: # Report the trail and carry on with the others
+                print(f'Trail {trailname} failed: {error!r}')
+    n_routes = gr_routecache.merge_route_cache(settings['route_cache'])
+    print(f'Merged {n_routes} new path queries into the route cache')
+
+    print_summary(results, time.time() - t_start)
+    return results
+
+if __name__=='__main__':
+
+    parser = argparse.ArgumentParser(description='Evaluates the GR quality criteria of a list of trails.')
+    parser.add_argument('trails', nargs='*', help='names of the trails in data_input, all GPX files by default')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes, all cores by default')
+    parser.add_argument('--store', default=default_settings['store'], help='path of the graph store')
+    parser.add_argument('--landuse-cache', default=default_settings['landuse_cache'], help='path of the landuse cache')
+    parser.add_argument('--stage-cache', default=default_settings['stage_cache'], help='path of the stage cache')
+    parser.add_argument('--route-cache', default=default_settings['route_cache'], help='path of the route cache')
+    parser.add_argument('--contract', action='store_true', help='search the paths on contracted routing graphs')
+    parser.add_argument('--rules', default=default_settings['rules'], help='rule set used to classify the segments')
+    args = parser.parse_args()
+
+    run_trails(args.trails or list_trails(), args.workers,
+               {'store':args.store, 'landuse_cache':args.landuse_cache, 'stage_cache':args.stage_cache,
+                'route_cache':args.route_cache, 'rules':args.rules,
+                'contract':args.contract})
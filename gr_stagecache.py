@@ -0,0 +1,112 @@
+import pandas as pd
+import numpy  as np
+import hashlib
+import json
+import os.path
+import gr_storage # Contains the typed storage of the pipeline stage outputs
+
+# Content-addressed cache of the pipeline stages (nodes, pieces, roads, places, processed) and of their batches.
+# Every artifact is stored under a key that hashes the parameters of its stage and the keys of its inputs, so when
+# a parameter, the GPX file or an upstream stage changes, the key changes with it and the stage is recomputed,
+# while artifacts whose inputs did not change are reused. Older artifacts stay on disk, so switching back to
+# earlier parameters (e.g. during a parameter sweep) is free.
+
+# Opens a stage cache, the manifest records the last key of every stage to report why a stage was recomputed
+def open_stage_cache(cache_path='cache/stages', fmt=None):
+
+    os.makedirs(cache_path, exist_ok=True)
+    filename = os.path.join(cache_path, 'manifest.json')
+    manifest = {}
+    if os.path.isfile(filename):
+        with open(filename) as file:
+            manifest = json.load(file)
+    return {'path':cache_path, 'fmt':fmt, 'manifest':manifest, 'updated':set(), 'hits':0, 'misses':0}
+
+# Writes the entries updated by this cache into the manifest, keeping the entries that other processes wrote meanwhile
+def write_manifest(cache):
+
+    filename = os.path.join(cache['path'], 'manifest.json')
+    manifest = {}
+    if os.path.isfile(filename):
+        with open(filename) as file:
+            manifest = json.load(file)
+    manifest.update({entry_name:cache['manifest'][entry_name] for entry_name in cache['updated']})
+    with open(f'{filename}.{os.getpid()}', 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(f'{filename}.{os.getpid()}', filename) # Readers never see a partially written manifest
+
+# Returns a hash of the contents of a dataframe (values and index), used as the key of raw inputs like the GPX points
+def hash_data(data):
+
+    data = data.copy()
+    for column in data.columns: # Tags hash the same whether they were computed (lists, objects) or loaded (categories)
+        if data[column].dtype==object or data[column].dtype=='category':
+            data[column] = np.where(data[column].isna(), '', data[column].astype(str))
+    sha = hashlib.sha1()
+    sha.update(','.join(str(column) for column in data.columns).encode())
+    sha.update(pd.util.hash_pandas_object(data, index=True).values.tobytes())
+    return sha.hexdigest()[:16]
+
+# Returns the key of a stage from its parameters and the keys of its inputs
+def get_key(stage, params, inputs):
+
+    text = json.dumps({'stage':stage, 'params':params, 'inputs':list(inputs)}, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+# Returns the version of the OSM data a graph store serves, downloads without a store are not versioned
+def get_store_version(store):
+
+    return store['version'] if store is not None else 'overpass'
+
+def get_filename_base(cache, name, stage, key):
+
+    return os.path.join(cache['path'], f'{name}_{stage}_{key}')
+
+# Prints which parameters or inputs changed since the last run of a stage
+def print_invalidation(cache, entry_name, params, inputs):
+
+    entry = cache['manifest'].get(entry_name)
+    if entry is None:
+        print(f'   No cached {entry_name} found, computing...')
+        return
+    changed = [p for p in sorted(set(params) | set(entry['params'])) if params.get(p)!=entry['params'].get(p)]
+    if list(inputs)!=entry['inputs']:
+        changed.append('inputs')
+    print(f'   Cached {entry_name} is outdated ({", ".join(changed) or "key"} changed), recomputing...')
+
+# Returns the output of a stage and its key, from the cache if a stage with the same key was computed before
+# compute is called without arguments when the stage needs to be (re)computed, stage is the gr_storage schema
+def run_stage(cache, name, stage, params, inputs, compute):
+
+    params = json.loads(json.dumps(params, default=str)) # Compare with the manifest as stored in JSON
+    key = get_key(stage, params, inputs)
+    filename_base = get_filename_base(cache, name, stage, key)
+    entry_name = f'{name}_{stage}'
+
+    if gr_storage.stage_exists(filename_base, cache['fmt']):
+        print(f'Loading cached {entry_name} ({key})...')
+        cache['hits'] += 1
+        data = gr_storage.read_stage(filename_base, stage, cache['fmt'])
+    else:
+        print(f'Computing {entry_name} ({key})...')
+        print_invalidation(cache, entry_name, params, inputs)
+        cache['misses'] += 1
+        data = gr_storage.apply_schema(compute(), stage) # Same types as when it is loaded from the cache
+        gr_storage.write_stage(data, filename_base, stage, cache['fmt'])
+
+    cache['manifest'][entry_name] = {'key':key, 'params':params, 'inputs':list(inputs)}
+    cache['updated'].add(entry_name)
+    write_manifest(cache)
+    return data, key
+
+# Returns the filename (without extension) of a batch, keyed on the contents of its input section and the parameters
+# Batches do not depend on their position in the trail, so changing the batch size only recomputes the new batches
+def get_batch_filename(cache, name, stage, params, section):
+
+    key = get_key(stage + '_batch', params, [hash_data(section.reset_index(drop=True))])
+    return get_filename_base(cache, name, stage + '_batch', key)
+
+def print_stats(cache):
+
+    total = cache['hits'] + cache['misses']
+    print(f'Stage cache: {cache["hits"]} of {total} stages reused')
@@ -0,0 +1,106 @@
+import pandas as pd
+import numpy  as np
+import os.path
+
+# Storage of the pipeline stage outputs (nodes, pieces, roads, places, processed) in a columnar binary format
+# Every stage has a typed schema, so the dtypes no longer depend on what pandas guesses when reading a file back.
+# Parquet and Feather need the pyarrow package, set default_format = 'csv' to keep working with CSV files.
+
+default_format = 'parquet'
+extensions = {'parquet':'.parquet', 'feather':'.feather', 'csv':'.csv'}
+
+# Typed schema of every stage, columns that are not listed keep their dtype
+tag_columns = {'highway':'category', 'surface':'category', 'tracktype':'category'}
+segment_columns = {'x0':float, 'y0':float, 'x1':float, 'y1':float, 'd_cart':float, 'd_osm':float, **tag_columns}
+place_columns = {**segment_columns, 'dev_dist':float, 'city8':'category', 'city9':'category'}
+schemas = {'nodes':{'point_x':float, 'point_y':float, 'node_id':np.int64, 'node_x':float, 'node_y':float,
+                    'd2node':float, 'd2bbox':float},
+           'pieces':{'node0':np.int64, 'node1':np.int64, 'gpx0':np.int64, 'gpx1':np.int64},
+           'roads':segment_columns,
+           'places':place_columns,
+           'processed':{**place_columns,
+                        'first_highway':'category', 'first_surface':'category', 'first_tracktype':'category',
+                        'paved':np.int64, 'traffic':np.int64, 'development':np.int64, 'gr_type':np.int64,
+                        'city':'category'}}
+
+# Casts the columns of a stage output to the types of its schema
+def apply_schema(data, stage):
+
+    for column, dtype in schemas[stage].items():
+        if column not in data.columns:
+            continue
+        if dtype=='category' and data[column].dtype!='category':
+            values = data[column]
+            values = np.where(values.isna(), None, values.astype(str)) # Lists of tags are stored like the CSV files did
+            data[column] = pd.Categorical(values)
+        elif dtype!='category':
+            data[column] = data[column].astype(dtype)
+    return data
+
+def check_format(fmt):
+
+    if fmt not in extensions:
+        raise ValueError(f'Unknown storage format <{fmt}>, use one of {list(extensions.keys())}')
+    if fmt!='csv':
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError(f'Storing stage outputs as {fmt} requires the pyarrow package, '
+                              f'or set gr_storage.default_format = \'csv\'.')
+
+# Returns the filename of a stage output, filename_base has no extension
+def get_stage_filename(filename_base, fmt=None):
+
+    return filename_base + extensions[fmt or default_format]
+
+# Returns the filename of an existing stage output, preferring the given format, or None if there is none
+# Files written in another format (e.g. CSV files of older runs) are used as well
+def find_stage_file(filename_base, fmt=None):
+
+    fmt = fmt or default_format
+    for f in [fmt] + [f for f in extensions if f!=fmt]:
+        if os.path.isfile(get_stage_filename(filename_base, f)):
+            return get_stage_filename(filename_base, f)
+    return None
+
+def stage_exists(filename_base, fmt=None):
+
+    return find_stage_file(filename_base, fmt) is not None
+
+def write_stage(data, filename_base, stage, fmt=None):
+
+    fmt = fmt or default_format
+    check_format(fmt)
+    data = apply_schema(data.copy(), stage)
+    filename = get_stage_filename(filename_base, fmt)
+    if fmt=='parquet':
+        data.to_parquet(filename)
+    elif fmt=='feather': # Feather has no index, so it is stored as a column
+        data.rename_axis('index').reset_index().to_feather(filename)
+    else:
+        data.to_csv(filename)
+    return filename
+
+# Returns 0 if a CSV file starts with an unnamed index column (written by DataFrame.to_csv), None otherwise
+# The road batches of older runs were written by csv.writer without an index column
+def get_index_col(filename):
+
+    header = pd.read_csv(filename, nrows=0).columns
+    return 0 if len(header)>0 and header[0].startswith('Unnamed: 0') else None
+
+def read_stage(filename_base, stage, fmt=None):
+
+    filename = find_stage_file(filename_base, fmt)
+    if filename is None:
+        raise ValueError(f'No stored {stage} file <{get_stage_filename(filename_base, fmt)}> was found.')
+
+    if filename.endswith('.parquet'):
+        check_format('parquet')
+        data = pd.read_parquet(filename)
+    elif filename.endswith('.feather'):
+        check_format('feather')
+        data = pd.read_feather(filename).set_index('index').rename_axis(None)
+    else:
+        dtypes = {column:(str if dtype=='category' else dtype) for column, dtype in schemas[stage].items()}
+        data = pd.read_csv(filename, index_col=get_index_col(filename), dtype=dtypes, float_precision='round_trip')
+    return apply_schema(data, stage)
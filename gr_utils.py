@@ -1,16 +1,10 @@
 import sys
-import re
+import hashlib
 import numpy as np
 import pandas as pd
 import os.path
-from csv import writer
-
-# This function returns a list with the [lat, lon] of each point within an OSM edge
-def edge_to_coords(network_edges,edge_id):
-    lon = list(network_edges.loc[(edge_id[0],edge_id[1])]['geometry'][0].coords.xy[0])
-    lat = list(network_edges.loc[(edge_id[0],edge_id[1])]['geometry'][0].coords.xy[1])
-    edge_coords = list(zip(lon,lat))
-    return [[coord[1],coord[0]] for coord in edge_coords]
+import xml.etree.ElementTree as ET
+import gr_storage # Contains the typed storage of the pipeline stage outputs
 
 # Distance between two points
 def cartesian_distance(lat0,lon0,lat1,lon1):
@@ -25,132 +19,200 @@ def cartesian_distance(lat0,lon0,lat1,lon1):
     dr = [r1[0] - r2[0], r1[1] - r2[1], r1[2] - r2[2]]
     return 1000.0*np.sqrt(dr[0]*dr[0] + dr[1]*dr[1] + dr[2]*dr[2])
 
+# Distances between every point P and every segment P0-P1, as a [len(P), len(P0)] matrix
+# Performs the same floating point operations as the scalar get_p2seg_distance, so the results are identical
+def get_p2seg_distances(P, P0, P1):
+    
+    P = np.asarray(P, dtype=float)
+    P0 = np.asarray(P0, dtype=float)
+    P1 = np.asarray(P1, dtype=float)
+    Px = P[:,0,None]
+    Py = P[:,1,None]
+    vx = P1[:,0] - P0[:,0]
+    vy = P1[:,1] - P0[:,1]
+    wx = Px - P0[:,0]
+    wy = Py - P0[:,1]
+    
+    c1 = wx*vx + wy*vy
+    c2 = vx*vx + vy*vy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b = c1/c2
+    
+    # Closest point on the segment: P0 if c1<=0, P1 if c2<=c1, the projection Pb otherwise
+    rx = Px - (P0[:,0] + b*vx)
+    ry = Py - (P0[:,1] + b*vy)
+    mask1 = c2<=c1
+    rx = np.where(mask1, Px - P1[:,0], rx)
+    ry = np.where(mask1, Py - P1[:,1], ry)
+    mask0 = c1<=0
+    rx = np.where(mask0, wx, rx)
+    ry = np.where(mask0, wy, ry)
+    
+    return np.sqrt(rx*rx + ry*ry)
+
+# Streams the track points (trkpt) and route points (rtept) of a GPX file into a DataFrame (latitude, longitude, elevation)
+# The file is parsed incrementally, so its formatting does not matter and memory use does not grow with the file size
+# Points without elevation get NaN, a time column is added when the points have timestamps, and a track column (one
+# number per trk/rte, in file order) when the file holds more than one track or route
+def parse_gpx(filename, chunk_size=65536):
+    
+    n = 0 # Number of points parsed
+    size = chunk_size # Size of the arrays, doubled when they are full
+    lat = np.empty(size)
+    lon = np.empty(size)
+    ele = np.full(size, np.nan)
+    time = np.full(size, None, dtype=object)
+    track = np.empty(size, dtype=int)
+    ntracks = 0
+    parent = None # Element holding the points, emptied regularly to keep memory bounded
+    names = {} # Tag without namespace of every tag that was seen
+    
+    for event, elem in ET.iterparse(filename, events=('start','end')):
+        tag = names.get(elem.tag)
+        if tag is None:
+            tag = names.setdefault(elem.tag, elem.tag.rsplit('}', 1)[-1]) # Drop the namespace
+        if event=='start':
+            if tag in ['trk','rte']:
+                ntracks += 1
+            if tag in ['trkseg','rte']:
+                parent = elem
+            continue
+        if tag not in ['trkpt','rtept']:
+            continue
+        
+        if n==size: # Grow the arrays
+            lat = np.concatenate((lat, np.empty(size)))
+            lon = np.concatenate((lon, np.empty(size)))
+            ele = np.concatenate((ele, np.full(size, np.nan)))
+            time = np.concatenate((time, np.full(size, None, dtype=object)))
+            track = np.concatenate((track, np.empty(size, dtype=int)))
+            size *= 2
+        lat[n] = float(elem.get('lat'))
+        lon[n] = float(elem.get('lon'))
+        track[n] = ntracks - 1
+        for child in elem:
+            child_tag = names.get(child.tag)
+            if child_tag=='ele' and child.text is not None and child.text.strip()!='':
+                ele[n] = float(child.text)
+            elif child_tag=='time' and child.text is not None:
+                time[n] = child.text.strip()
+        n += 1
+        
+        elem.clear()
+        if parent is not None and len(parent)>=chunk_size:
+            del parent[:] # All points in the parent were handled
+    
+    trail = pd.DataFrame({'latitude':lat[:n], 'longitude':lon[:n], 'elevation':ele[:n]})
+    if np.any(time[:n]!=None):
+        trail['time'] = pd.to_datetime(time[:n], utc=True).tz_localize(None) # In UTC
+    if ntracks>1:
+        trail['track'] = track[:n]
+    return trail
+
 # Converts a GPX file into a CSV file with a list of the latitude/longitude/elevation points
 def process_gpx(filename_in, filename_out):
     
-    with open(filename_in) as file:
-        raw = file.read()
-
-    # Use Regex to grab all lat/lon pairs
-#     pattern = re.compile(r'lat="(?P<lat>\d+.\d+)" lon="(?P<lon>\d+.\d+)">\n\s+<ele>(?P<ele>\d+)<') # did not account for negative elevations
-    pattern = re.compile(r'<trkpt lat="(?P<lat>\d+.\d+)" lon="(?P<lon>\d+.\d+)">\n\s+<ele>(?P<ele>(?:-?\d+)?)</ele>')
-    dat = pattern.findall(raw)
-
-    # Write the lat/lon pairs to a CSV file
-    with open(filename_out, "w") as file:
-        csv_writer = writer(file)
-        csv_writer.writerow(['latitude','longitude','elevation'])
-        for row in dat:
-            csv_writer.writerow(row)
+    parse_gpx(filename_in).to_csv(filename_out, index=False)
             
-def write_batch(filename, segment_list):
+def write_batch(filename_base, segment_list, fmt=None):
     
     print('   Writing outputs to file...')
-    with open(filename, 'w') as file:
-        csv_writer = writer(file)
-        headers = ['x0','y0','x1','y1','d_cart','d_osm','highway','surface','tracktype']
-        csv_writer.writerow(headers)
-        for segment in segment_list:
-            csv_writer.writerow(segment)
+    headers = ['x0','y0','x1','y1','d_cart','d_osm','highway','surface','tracktype']
+    gr_storage.write_stage(pd.DataFrame(segment_list, columns=headers), filename_base, 'roads', fmt)
             
-def write_batch_places(filename, data_roads_section):
+def write_batch_places(filename_base, data_roads_section, fmt=None):
     
     print('   Writing outputs to file...')
-    data_roads_section.to_csv(filename)
-#     with open(filename, 'w') as file:
-#         csv_writer = writer(file)
-#         headers = ['x0','y0','x1','y1','d_cart','d_osm','highway','surface','tracktype','dev_dist']
-#         csv_writer.writerow(headers)
-#         for i, segment in data_roads_section.iterrows():
-#             csv_writer.writerow(segment)
+    gr_storage.write_stage(data_roads_section, filename_base, 'places', fmt)
             
-def merge_roads(trailname, trail, points_per_batch):
-    
-    n_batch = int(np.ceil(trail.shape[0]/points_per_batch)) # Number of batches to be run
-    
-    # Load the first batch
-    filename = f'cache/{trailname}_roads_0to{points_per_batch}.csv'
-    data = pd.read_csv(filename,dtype={'highway':str, 'surface': str, 'tracktype':str})
-    
-    # Load and merge the remaining batches
-    for b in range(1,n_batch): # b is the batch counter
-        n1 = b*points_per_batch # First point
-        n2 = min(n1 + points_per_batch, len(trail)) # Last point
-        filename = f'cache/{trailname}_roads_{n1}to{n2}.csv'
-        data_new = pd.read_csv(filename,dtype={'highway':str, 'surface': str, 'tracktype':str})
-        data = pd.concat([data,data_new],ignore_index=True)
+# batch_files are the filenames returned by trail2roads, by default the batch filenames are derived from points_per_batch
+def merge_roads(trailname, trail, points_per_batch, fmt=None, batch_files=None):
+    
+    if batch_files is None:
+        n_batch = int(np.ceil(trail.shape[0]/points_per_batch)) # Number of batches to be run
+        batch_files = []
+        for b in range(n_batch): # b is the batch counter
+            n1 = b*points_per_batch # First point
+            n2 = min(n1 + points_per_batch, len(trail)) # Last point
+            batch_files.append(f'cache/{trailname}_roads_{n1}to{n2}')
+    
+    # Load all batches and merge them
+    batches = [gr_storage.read_stage(filename, 'roads', fmt) for filename in batch_files]
+    data = pd.concat(batches, ignore_index=True)
         
-    return data
+    return gr_storage.apply_schema(data, 'roads')
 
-def write_roads(trailname, data_roads):
+def write_roads(trailname, data_roads, fmt=None):
     
-    filename = f'cache/{trailname}_roads.csv'
-    data_roads.to_csv(filename)
+    gr_storage.write_stage(data_roads, f'cache/{trailname}_roads', 'roads', fmt)
 
-def read_roads(trailname):
+def read_roads(trailname, fmt=None):
     
-    filename = f'cache/{trailname}_roads.csv'
-    return pd.read_csv(filename,dtype={'highway':str, 'surface': str, 'tracktype':str},index_col=0)
+    return gr_storage.read_stage(f'cache/{trailname}_roads', 'roads', fmt)
 
-def merge_places(trailname, data_roads, points_per_batch_places):
-    
-    n_batch = int(np.ceil(data_roads.shape[0]/points_per_batch_places)) # Number of batches to be run
-    
-    # Load the first batch
-    filename = f'cache/{trailname}_places_0to{points_per_batch_places-1}.csv'
-    data = pd.read_csv(filename,dtype={'highway':str, 'surface': str, 'tracktype':str},index_col=0)
-    
-    # Load and merge the remaining batches
-    for b in range(1,n_batch): # b is the batch counter
-        n1 = b*points_per_batch_places # First point
-        n2 = min(n1 + points_per_batch_places, data_roads.shape[0]) - 1 # Last point
-#         print(f'Merging section n1={n1} to n2={n2}')
-#         print(f'no of rows {data_roads.shape[0]}')
-        filename = f'cache/{trailname}_places_{n1}to{n2}.csv'
-        data_new = pd.read_csv(filename,dtype={'highway':str, 'surface': str, 'tracktype':str},index_col=0)
-        data = pd.concat([data,data_new],ignore_index=True)
+# batch_files are the filenames returned by roads2places, by default the batch filenames are derived from points_per_batch_places
+def merge_places(trailname, data_roads, points_per_batch_places, fmt=None, batch_files=None):
+    
+    if batch_files is None:
+        n_batch = int(np.ceil(data_roads.shape[0]/points_per_batch_places)) # Number of batches to be run
+        batch_files = []
+        for b in range(n_batch): # b is the batch counter
+            n1 = b*points_per_batch_places # First point
+            n2 = min(n1 + points_per_batch_places, data_roads.shape[0]) - 1 # Last point
+            batch_files.append(f'cache/{trailname}_places_{n1}to{n2}')
+    
+    # Load all batches and merge them
+    batches = [gr_storage.read_stage(filename, 'places', fmt) for filename in batch_files]
+    data = pd.concat(batches, ignore_index=True)
         
-    return data
+    return gr_storage.apply_schema(data, 'places')
 
-def write_places(trailname, data_places):
+def write_places(trailname, data_places, fmt=None):
+    
+    gr_storage.write_stage(data_places, f'cache/{trailname}_places', 'places', fmt)
     
-    filename = f'cache/{trailname}_places.csv'
-    data_places.to_csv(filename)
+# The processed data are the final output, use fmt='csv' to export them as CSV
+def write_processed(trailname, data, fmt=None):
     
-def write_processed(trailname, data):
+    gr_storage.write_stage(data, f'data_output/{trailname}_processed', 'processed', fmt)
     
-    filename = f'data_output/{trailname}_processed.csv'
-    data.to_csv(filename)
+def read_processed(trailname, fmt=None):
     
-def read_processed(trailname):
+    return gr_storage.read_stage(f'data_output/{trailname}_processed', 'processed', fmt)
+
+def read_places(trailname, fmt=None):
     
-    filename_processed = 'data_output/' + trailname + '_processed.csv'
-    if not os.path.isfile(filename_processed): # The PROCESSED file does not exist
-        ValueError('Error file not found, did you process it?')
-    data = pd.read_csv(filename_processed,
-                       dtype={'highway':str, 'surface': str, 'tracktype':str,
-                              'city8':str, 'city9':str, 'city':str},
-                       index_col=0)
-    return data
+    return gr_storage.read_stage(f'cache/{trailname}_places', 'places', fmt)
 
-def read_places(trailname):
+# Returns the hash of the GPX file of a trail, stored with its parsed points to tell when the GPX file changed
+def get_gpx_hash(filename_gpx):
     
-    filename = f'cache/{trailname}_places.csv'
-    return pd.read_csv(filename,dtype={'highway':str, 'surface': str, 'tracktype':str},index_col=0)
+    with open(filename_gpx, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
 
+# Loads the points of a trail, the parsed GPX file is cached as a binary .npz file in data_output
+# The GPX file is parsed again when it changed since it was cached
 def get_gpx(trailname):
     
     filename_gpx = 'data_input/' + trailname + '.gpx'
-    filename_csv = 'data_output/' + trailname + '.csv'
-    if not os.path.isfile(filename_csv): # The GPX file was not processed into a clean CSV file before
-        if not os.path.isfile(filename_gpx): # The GPX file does not exist, throw error
-            raise ValueError(f'The GPX file <{filename_gpx}> was not found! Please make sure it exists.')
-        else: # The GPX file exists, so convert it into a clean CSV file
-            print(f'Converting GPX file <{filename_gpx}> into cleaned CSV file <{filename_csv}>...')
-            process_gpx(filename_gpx,filename_csv)
+    filename_npz = 'data_output/' + trailname + '.npz'
+    if not os.path.isfile(filename_gpx) and not os.path.isfile(filename_npz): # The GPX file does not exist, throw error
+        raise ValueError(f'The GPX file <{filename_gpx}> was not found! Please make sure it exists.')
+    if os.path.isfile(filename_gpx): # Parse the GPX file if it was not parsed before, or changed since
+        source = get_gpx_hash(filename_gpx)
+        if os.path.isfile(filename_npz):
+            with np.load(filename_npz) as file:
+                parsed = 'source' in file.files and str(file['source'])==source
+        else:
+            parsed = False
+        if not parsed:
+            print(f'Parsing GPX file <{filename_gpx}> into binary file <{filename_npz}>...')
+            trail = parse_gpx(filename_gpx)
+            np.savez(filename_npz, source=source, **{column:trail[column].values for column in trail.columns})
             print('Completed conversion.')
-    print(f'Loading trail points from <{filename_gpx}>...')
-    trail = pd.read_csv(filename_csv) # Now read the cleaned CSV file into a DataFrame (latitude, longitude, elevation)
+    print(f'Loading trail points from <{filename_npz}>...')
+    with np.load(filename_npz) as file:
+        trail = pd.DataFrame({column:file[column] for column in file.files if column!='source'}) # latitude, longitude, elevation (& time, track)
     print('Finished loading.')
     
     return trail
\ No newline at end of file
@@ -0,0 +1,208 @@
+import pandas as pd
+import numpy  as np
+import networkx as nx
+import shapely
+import time
+import gr_mapmatch # Contains functions that perform the map matching of roads
+import roadmatch # Contains the nearest-node + k-shortest-paths matching engine
+
+# HMM map matching: every GPX point gets several candidate positions on nearby edges, the emission probability
+# scores how far a candidate lies from its GPX point, the transition probability scores how well the route distance
+# between two candidates agrees with the distance between their GPX points. The most likely sequence of candidates
+# is decoded with Viterbi, and the traversed edges are returned in the same segment format as roadmatch.
+
+##############################
+## --- Helper functions --- ##
+##############################
+
+# Finds up to max_candidates edges within radius [deg] of each GPX point, nearest first
+# Returns a dataframe [point, edge, t, d] with the edge row in network['edges'], the position t along the edge
+# (0 at the start, 1 at the end) and the distance d [m] between the GPX point and its projection on the edge
+def get_candidates(network, trail_coords, radius, max_candidates):
+
+    coords = np.array(trail_coords, dtype=float).reshape(-1,2)
+    points = shapely.points(coords[:,1], coords[:,0])
+    geoms = network['edges']['geometry'].values
+    point_idx, edge_idx = gr_mapmatch.get_edge_tree(network).query(points, predicate='dwithin', distance=radius)
+
+    # Keep the nearest candidates of each point
+    d_deg = shapely.distance(points[point_idx], geoms[edge_idx])
+    order = np.lexsort((d_deg, point_idx))
+    point_idx = point_idx[order]
+    edge_idx = edge_idx[order]
+    rank = np.arange(len(point_idx)) - np.searchsorted(point_idx, point_idx)
+    keep = rank < max_candidates
+    point_idx = point_idx[keep]
+    edge_idx = edge_idx[keep]
+
+    # Project the GPX points on their candidate edges
+    t = shapely.line_locate_point(geoms[edge_idx], points[point_idx], normalized=True)
+    proj = shapely.line_interpolate_point(geoms[edge_idx], t, normalized=True)
+    d = gr_mapmatch.cartesian_distance(coords[point_idx,0], coords[point_idx,1], shapely.get_y(proj), shapely.get_x(proj))
+
+    return pd.DataFrame({'point':point_idx, 'edge':edge_idx, 't':t, 'd':d})
+
+# Bounded Dijkstra from a node, cached per source node so it is computed once per trail
+def get_reachable(network, cache, node_id, max_route):
+
+    if node_id not in cache:
+        cache[node_id] = nx.dijkstra_predecessor_and_distance(network['graph'], node_id, cutoff=max_route, weight='length')
+    return cache[node_id]
+
+# True if candidate b lies on the same edge as candidate a and not more than sigma [m] behind it
+# A small step backwards is GPX noise, not a U-turn
+def is_same_edge(edge_length, a, b, sigma):
+
+    return a['edge']==b['edge'] and (a['t'] - b['t'])*edge_length[a['edge']]<=sigma
+
+# Route distance [m] from candidate a to candidate b, np.inf if b is not reachable within max_route
+def get_route_distance(network, cache, edge_u, edge_v, edge_length, a, b, sigma, max_route):
+
+    if is_same_edge(edge_length, a, b, sigma): # Moving along the same edge
+        return max(b['t'] - a['t'], 0)*edge_length[a['edge']]
+
+    pred, dist = get_reachable(network, cache, edge_v[a['edge']], max_route)
+    d_between = dist.get(edge_u[b['edge']], np.inf)
+    return (1 - a['t'])*edge_length[a['edge']] + d_between + b['t']*edge_length[b['edge']]
+
+# Follows the Dijkstra predecessors back from node_id_end to the source of the tree
+def get_tree_path(pred, node_id_end):
+
+    path = [node_id_end]
+    while len(pred[path[-1]])>0:
+        path.append(pred[path[-1]][0])
+    return path[::-1]
+
+##############################
+## --- Viterbi decoding --- ##
+##############################
+
+# Decodes the most likely sequence of candidates, returns one list of candidate indices per connected chain
+# The chain is broken (and restarted) when no candidate of a point can be reached from the previous point
+def decode(network, candidates, trail_coords, sigma, beta, max_route):
+
+    edge_u = network['edges'].index.get_level_values(0).values
+    edge_v = network['edges'].index.get_level_values(1).values
+    edge_length = network['edges']['length'].values
+    coords = np.array(trail_coords, dtype=float).reshape(-1,2)
+    cache = {}
+
+    groups = [group.index.values for _, group in candidates.groupby('point', sort=True)]
+    rows = candidates.to_dict('index')
+    log_emission = -0.5*(candidates['d'].values/sigma)**2
+
+    chains = []
+    back = [] # Backpointers of the current chain, one array per step
+    score = log_emission[groups[0]]
+    prev = groups[0]
+    for g in range(1, len(groups)):
+        cur = groups[g]
+        p0 = rows[prev[0]]['point']
+        p1 = rows[cur[0]]['point']
+        d_gpx = gr_mapmatch.cartesian_distance(coords[p0,0], coords[p0,1], coords[p1,0], coords[p1,1])
+
+        # Transition log-probabilities between all candidate pairs of the two points
+        log_transition = np.full((len(prev), len(cur)), -np.inf)
+        for i in range(len(prev)):
+            for j in range(len(cur)):
+                d_route = get_route_distance(network, cache, edge_u, edge_v, edge_length, rows[prev[i]], rows[cur[j]], sigma, max_route)
+                if np.isfinite(d_route):
+                    log_transition[i,j] = -abs(d_route - d_gpx)/beta
+
+        total = score[:,None] + log_transition
+        best = np.argmax(total, axis=0)
+        new_score = total[best, np.arange(len(cur))] + log_emission[cur]
+        if np.all(np.isinf(new_score)): # No connection, close this chain and start a new one
+            chains.append(backtrack(prev, score, back))
+            back = []
+            new_score = log_emission[cur]
+            best = None
+        back.append((prev, best))
+        score = new_score
+        prev = cur
+
+    chains.append(backtrack(prev, score, back))
+    return chains, cache
+
+# Follows the backpointers from the best final candidate to the start of the chain
+def backtrack(last, score, back):
+
+    k = int(np.argmax(score))
+    sequence = [last[k]]
+    for prev, best in back[::-1]:
+        if best is None:
+            break
+        k = best[k]
+        sequence.append(prev[k])
+    return sequence[::-1]
+
+#################################
+## --- HMM matching engine --- ##
+#################################
+
+# Converts the decoded candidate chains into the list of traversed nodes, one list per chain
+def chains_to_nodes(network, candidates, chains, cache, sigma, max_route):
+
+    edge_u = network['edges'].index.get_level_values(0).values
+    edge_v = network['edges'].index.get_level_values(1).values
+    edge_length = network['edges']['length'].values
+    rows = candidates.to_dict('index')
+    node_lists = []
+    for chain in chains:
+        a = rows[chain[0]]
+        node_list = [edge_u[a['edge']], edge_v[a['edge']]]
+        for k in range(1, len(chain)):
+            b = rows[chain[k]]
+            if is_same_edge(edge_length, a, b, sigma): # Still on the same edge
+                if b['t']>a['t']:
+                    a = b
+                continue
+            pred, dist = get_reachable(network, cache, edge_v[a['edge']], max_route)
+            node_list.extend(get_tree_path(pred, edge_u[b['edge']])[1:]) # Path from the end of edge a to the start of edge b
+            node_list.append(edge_v[b['edge']])
+            a = b
+        node_lists.append(gr_mapmatch.remove_successive_duplicates(node_list))
+    return node_lists
+
+# Matches a whole trail against a (corridor) network with the HMM engine
+# radius [deg] limits the candidate search, sigma [m] is the GPX position error, beta [m] scales the transition
+# probability and max_route [m] bounds the route distance between two successive GPX points
+def match_trail(network, trail_coords, radius=0.001, max_candidates=8, sigma=20.0, beta=50.0, max_route=2000.0):
+
+    candidates = get_candidates(network, trail_coords, radius, max_candidates)
+    if candidates.shape[0]==0:
+        raise ValueError(f'No edges found within {radius} deg of the GPX points')
+    chains, cache = decode(network, candidates, trail_coords, sigma, beta, max_route)
+    node_lists = chains_to_nodes(network, candidates, chains, cache, sigma, max_route)
+
+    total_route = []
+    for node_list in node_lists:
+        for j in range(len(node_list)-1):
+            total_route.extend(gr_mapmatch.get_segments(network, node_list[j], node_list[j+1]))
+    print(f'Matched {len(trail_coords)} GPX points in {len(chains)} chain(s), ran {len(cache)} bounded Dijkstra searches')
+
+    return pd.DataFrame(total_route,columns=['x0','y0','x1','y1','d_cart','d_osm','highway','surface','tracktype'])
+
+# Times the current engine (nearest node + k-shortest-paths) against the HMM engine on the same corridor network
+# Returns the segments of both engines and prints their throughput in GPX points per second, e.g. for gr131:
+#     gpx = gr_utils.get_gpx('gr131')
+#     network = gr_mapmatch.get_corridor_network(gpx, delta_roads)
+#     segments_current, segments_hmm = hmmmatch.benchmark(gpx, network, npaths)
+def benchmark(gpx, network, npaths, **hmm_settings):
+
+    gpx_coords = gr_mapmatch.trail_to_coords(gpx)
+
+    t0 = time.time()
+    nodes = roadmatch.gpx_to_nodes_corridor(gpx, gpx_coords, network)
+    pieces = roadmatch.nodes_to_pieces(nodes)
+    segments_current = roadmatch.pieces_to_segments_corridor(nodes, pieces, npaths, network)
+    t_current = time.time() - t0
+
+    t0 = time.time()
+    segments_hmm = match_trail(network, gpx_coords, **hmm_settings)
+    t_hmm = time.time() - t0
+
+    print(f'Current engine: {t_current:.1f} s, {len(gpx)/t_current:.0f} GPX points/s, {len(segments_current)} segments')
+    print(f'HMM engine:     {t_hmm:.1f} s, {len(gpx)/t_hmm:.0f} GPX points/s, {len(segments_hmm)} segments')
+
+    return segments_current, segments_hmm
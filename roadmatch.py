@@ -1,12 +1,18 @@
 import osmnx  as ox
 import pandas as pd
 import numpy  as np
+import networkx as nx
+import shapely
 from itertools import groupby
 import gr_utils # Contains useful geometry functions
 from csv import writer
 import warnings
 import os.path
 import gr_mapmatch # Contains functions that perform the map matching of roads
+import gr_routecache # Contains the memo of path queries
+import gr_parallel # Contains the parallel execution of batches
+import gr_contract # Contains the pruned and contracted routing graph
+import gr_csr # Contains the compact CSR routing graph
 
 ##############################
 ## --- Helper functions --- ##
@@ -78,15 +84,7 @@ def print_overwrite(text):
 
 def get_path_error(route,trail_coords):
     
-    xy = get_coords_from_route(route)
-    err = 0
-    for point in trail_coords: # for each point from the gpx
-        dmin = 999
-        for j in range(len(xy)-1): # find the min distance to the pathfind
-            dmin = min(dmin,get_p2seg_distance(point,xy[j],xy[j+1]))
-        err += dmin*dmin # save the squared error
-        
-    return err
+    return gr_mapmatch.get_path_error(route,trail_coords)
 
 # def gpx2points(gpx):
     
@@ -95,13 +93,6 @@ def get_path_error(route,trail_coords):
 #     points = list(zip(x,y))
 #     return [[point[1],point[0]] for point in points]
 
-def edge_to_coords(network_edges,edge_id):
-    
-    lon = list(network_edges.loc[(edge_id[0],edge_id[1])]['geometry'][0].coords.xy[0])
-    lat = list(network_edges.loc[(edge_id[0],edge_id[1])]['geometry'][0].coords.xy[1])
-    edge_coords = list(zip(lon,lat))
-    return [[coord[1],coord[0]] for coord in edge_coords]
-
 def point2rectangle(rect, P):
     Px = P[1]
     Py = P[0]
@@ -119,6 +110,12 @@ def get_point_to_bbox_distance(point_x,point_y,bbox):
     d3 = get_p2seg_distance([point_y,point_x],bbox[3],bbox[0])
     return min(d0,d1,d2,d3)
 
+# Vectorized get_point_to_bbox_distance for arrays of points
+def get_points_to_bbox_distances(point_x,point_y,bbox):
+    
+    P = np.column_stack((point_y,point_x))
+    return gr_utils.get_p2seg_distances(P,bbox[:-1],bbox[1:]).min(axis=1)
+
 def get_bbox(lat_min, lat_max, lon_min, lon_max):
     
     return [[lat_min,lon_min],[lat_min,lon_max],[lat_max,lon_max],[lat_max,lon_min],[lat_min,lon_min]]
@@ -128,280 +125,393 @@ def get_bbox(lat_min, lat_max, lon_min, lon_max):
 ## --- Road matching functions --- ##
 #####################################
 
-# Converts gpx points to nodes dataframe
-def gpx_to_nodes(gpx, gpx_coords, points_per_batch, delta_roads, min_dist_from_bbox):
+# Converts gpx points to nodes dataframe, with workers>1 the batches are matched in parallel (see gr_parallel)
+# With a fetcher the networks of the next batches are downloaded while a batch is matched (only with workers=1)
+def gpx_to_nodes(gpx, gpx_coords, points_per_batch, delta_roads, min_dist_from_bbox, store=None, workers=1, fetcher=None):
 
     n_trail = len(gpx) # Number of GPX points in the trail
     n_batch = int(np.ceil(gpx.shape[0]/points_per_batch)) # Number of batches to be run
-    nodes = pd.DataFrame() # ID of node matched to each GPX point
+    if workers!=1: # The fetcher is not shared between processes
+        store = gr_parallel.get_worker_store(store)
+        fetcher = None
 
     ## --- Loop over all sections of the trail
+    tasks = []
     for b in range(n_batch): # Using batch counter b
 
         # Define the range of GPX points to process in the current batch
         n1 = b*points_per_batch # First point of this batch
         n2 = min(n1 + points_per_batch, n_trail) # Last point of this batch (clipped)
-
-        print_overwrite(f"\rHandling batch #{b}/{n_batch-1} spanning GPX points {n1} through {n2-1}")
-
         gpx_section = gpx.loc[n1:n2] # Select that range of GPX points
         section_coords = gpx_coords[n1:n2] # Convert the points into a list of [lat, lon] pairs
+        tasks.append((b, n_batch, gpx_section, section_coords, n1, n2, delta_roads, min_dist_from_bbox, store))
 
-        lat_min, lat_max, lon_min, lon_max = gr_mapmatch.get_bbox(gpx_section,delta_roads) # Calculate the bounding box
-        network = gr_mapmatch.get_osm_network(lat_min, lat_max, lon_min, lon_max) # Download the street network from OSM
-        new_nodes = gr_mapmatch.match_nodes_vec(network,section_coords) # Calculate corresponding node for each GPX point
-        bbox = get_bbox(lat_min, lat_max, lon_min, lon_max) 
+    # Networks of the batches that follow each batch
+    bboxes = [gr_mapmatch.get_bbox(task[2], delta_roads) for task in tasks]
+    tasks = [task + (fetcher, bboxes[b+1:]) for b, task in enumerate(tasks)]
+    batches = gr_parallel.run_batches(match_nodes_batch, tasks, workers) # Nodes matched to the GPX points of each batch
 
-        delta_lat = lat_max - lat_min
-        delta_lon = lon_max - lon_min
+    return pd.concat(batches)
+
+# Matches the GPX points n1 through n2-1 of a single batch to nodes, gpx_section also holds point n2
+def match_nodes_batch(b, n_batch, gpx_section, section_coords, n1, n2, delta_roads, min_dist_from_bbox, store=None,
+                      fetcher=None, next_bboxes=()):
+
+    print_overwrite(f"\rHandling batch #{b}/{n_batch-1} spanning GPX points {n1} through {n2-1}")
+    gr_mapmatch.prefetch_networks(fetcher, next_bboxes, store)
+
+    lat_min, lat_max, lon_min, lon_max = gr_mapmatch.get_bbox(gpx_section,delta_roads) # Calculate the bounding box
+    network = gr_mapmatch.get_osm_network(lat_min, lat_max, lon_min, lon_max, store, fetcher) # Download the street network from OSM
+    new_nodes = gr_mapmatch.match_nodes_vec(network,section_coords) # Calculate corresponding node for each GPX point
+    bbox = get_bbox(lat_min, lat_max, lon_min, lon_max) 
+
+    delta_lat = lat_max - lat_min
+    delta_lon = lon_max - lon_min
+    
+    # Calculate distance between each GPX point and its corresponding node, in this batch
+    coords = np.array(section_coords, dtype=float).reshape(-1,2)
+    node_ids = np.array(new_nodes)
+    node_x = network['points']['x'].reindex(node_ids).values
+    node_y = network['points']['y'].reindex(node_ids).values
+    dy = coords[:,0] - node_y
+    dx = coords[:,1] - node_x
+    nodes = pd.DataFrame({'point_x':coords[:,1], 'point_y':coords[:,0],
+                          'node_id':node_ids,
+                          'node_x':node_x, 'node_y':node_y,
+                          'd2node':np.sqrt(dy*dy + dx*dx), # Distance from GPX point to node
+                          'd2bbox':get_points_to_bbox_distances(node_x,node_y,bbox)}, # Distance from node to bbox
+                         index=np.arange(n1,n2))
         
-        # Calculate distance between each GPX point and its corresponding node, in this batch
-        dvec = []
-        for j in range(len(section_coords)):
-            point_id = n1 + j
-            point_y = section_coords[j][0]
-            point_x = section_coords[j][1]
-            node_id = new_nodes[j]
-            node = network['points'].loc[node_id]
+    # If we find any matched nodes of this batch that are close to the bounding box, recalculate with a bigger network!
+    for idx, row in nodes[nodes['d2bbox']<min_dist_from_bbox].iterrows():
+
+        print(f'Point {idx} should be recalculated!')
+        found = False
+
+        # Now we need a while loop that checks a larger network around this point
+        k = 0 # Counter for how many times we increased the bbox
+        new_lat_min = row['point_y'] - delta_lat/2
+        new_lat_max = row['point_y'] + delta_lat/2
+        new_lon_min = row['point_x'] - delta_lon/2
+        new_lon_max = row['point_x'] + delta_lon/2
+
+        while not found:
+            
+            print(f'Recalculating with larger bbox, k = {k}')
+            
+            # Updating the bounding box using counter k
+            temp_lat_min = new_lat_min - k*delta_roads
+            temp_lat_max = new_lat_max + k*delta_roads
+            temp_lon_min = new_lon_min - k*delta_roads
+            temp_lon_max = new_lon_max + k*delta_roads
+            
+            new_bbox = get_bbox(temp_lat_min, temp_lat_max, temp_lon_min, temp_lon_max) 
+            
+            # New node matching
+            new_network = gr_mapmatch.get_osm_network(temp_lat_min, temp_lat_max, temp_lon_min, temp_lon_max, store, fetcher)
+            nearest_edges = ox.distance.nearest_edges(new_network['graph'],row['point_x'],row['point_y'])
+            nearest_edge_end = gr_mapmatch.get_nearest_edge_end(
+                new_network,nearest_edges,[row['point_x'],row['point_y']]) # make sure the point coords are in nthe right order here!!!!!
+            node_id = nearest_edge_end
+            node = new_network['points'].loc[node_id]
             node_x = node['x']
             node_y = node['y']
-            # Distance from GPX point to node
-            d2node = gr_mapmatch.get_dist(section_coords[j],[node_y,node_x]) # distance from gpx point to matching node
-            # Distance from node to bbox
-            d2bbox = get_point_to_bbox_distance(node_x,node_y,bbox)
-            # Storing
-            newrow = pd.DataFrame({'point_x':point_x, 'point_y':point_y,
-                                   'node_id':node_id,
-                                   'node_x':node_x, 'node_y':node_y,
-                                   'd2node':d2node, 'd2bbox':d2bbox},index={point_id})
-            nodes = pd.concat([nodes,newrow])
-            
-        # If we find any matched nodes that are close to the bounding box, recalculate with a bigger network!
-        for idx, row in nodes.iterrows():
-        
-            if row['d2bbox']<min_dist_from_bbox:
-
-                print(f'Point {idx} should be recalculated!')
-                found = False
-
-                # Now we need a while loop that checks a larger network around this point
-                k = 0 # Counter for how many times we increased the bbox
-                new_lat_min = row['point_y'] - delta_lat/2
-                new_lat_max = row['point_y'] + delta_lat/2
-                new_lon_min = row['point_x'] - delta_lon/2
-                new_lon_max = row['point_x'] + delta_lon/2
-
-                while not found:
-                    
-                    print(f'Recalculating with larger bbox, k = {k}')
-                    
-                    # Updating the bounding box using counter k
-                    temp_lat_min = new_lat_min - k*delta_roads
-                    temp_lat_max = new_lat_max + k*delta_roads
-                    temp_lon_min = new_lon_min - k*delta_roads
-                    temp_lon_max = new_lon_max + k*delta_roads
-                    
-                    new_bbox = get_bbox(temp_lat_min, temp_lat_max, temp_lon_min, temp_lon_max) 
-                    
-                    # New node matching
-                    new_network = gr_mapmatch.get_osm_network(temp_lat_min, temp_lat_max, temp_lon_min, temp_lon_max)
-                    nearest_edges = ox.distance.nearest_edges(new_network['graph'],row['point_x'],row['point_y'])
-                    nearest_edge_end = gr_mapmatch.get_nearest_edge_end(
-                        new_network,nearest_edges,[row['point_x'],row['point_y']]) # make sure the point coords are in nthe right order here!!!!!
-                    node_id = nearest_edge_end
-                    node = new_network['points'].loc[node_id]
-                    node_x = node['x']
-                    node_y = node['y']
-                    d2bbox = get_point_to_bbox_distance(node_x,node_y,new_bbox)
-                    print(f'new distance is {d2bbox} but ')
-                    if d2bbox>min_dist_from_bbox:
-                        d2node = gr_mapmatch.get_dist([row['point_y'],row['point_x']],
-                                                      [node_y,node_x]) # distance from gpx point to matching node
-                        nodes.loc[idx,'node_id'] = node_id
-                        nodes.loc[idx,'node_x'] = node_x
-                        nodes.loc[idx,'node_y'] = node_y
-                        nodes.loc[idx,'d2node'] = d2node
-                        nodes.loc[idx,'d2bbox'] = d2bbox
-                        break
-                    else:
-                        k += 1 # retry with a larger bbox
+            d2bbox = get_point_to_bbox_distance(node_x,node_y,new_bbox)
+            print(f'new distance is {d2bbox} but ')
+            if d2bbox>min_dist_from_bbox:
+                d2node = gr_mapmatch.get_dist([row['point_y'],row['point_x']],
+                                              [node_y,node_x]) # distance from gpx point to matching node
+                nodes.loc[idx,'node_id'] = node_id
+                nodes.loc[idx,'node_x'] = node_x
+                nodes.loc[idx,'node_y'] = node_y
+                nodes.loc[idx,'d2node'] = d2node
+                nodes.loc[idx,'d2bbox'] = d2bbox
+                break
+            else:
+                k += 1 # retry with a larger bbox
 
     return nodes
 
 # Converts nodes dataframe to pieces dataframe
 def nodes_to_pieces(nodes):
     
-    pieces = pd.DataFrame()
-    k = 0 # piece counter
-    n = nodes.shape[0] # nrows in node_list
-    j0 = 0
-    j1 = j0
-    j2 = j0
-
-    while j2<n-1:
-
-        node0 = nodes.loc[j0]['node_id']
-        j1 = j0 + 1
-        node1 = nodes.loc[j1]['node_id']
-
-        # increment j1 until we find a different node
-        while node1==node0:
-            j1 += 1
-            node1 = nodes.loc[j1]['node_id']
-
-        # increment j2 until we find another node
-        j2 = j1
-        node2 = nodes.loc[j2]['node_id']
-        while node2==node1:
-            if j2 == n-1: # we have reached the end of the gpx dataframe
-                break
-            j2 += 1
-            node2 = nodes.loc[j2]['node_id']
-
-        if j2 == n-1:
-            j3 = j2
-        else:
-            # find the gpx point between j1 and j2 that is nearest to node1
-            temp = nodes.loc[j1:j2-1]
-            j3 = temp['d2node'].idxmin()
-
-        # pathfinding is to take place between j0 and j3, add to pieces list
-        newrow = pd.DataFrame({'node0':node0, 'node1':node1, 'gpx0':j0, 'gpx1':j3},index={k}).astype(int)
-        pieces = pd.concat([pieces,newrow])
-        k += 1
-
-        # move to the next piece by setting j0 = j3
-        j0 = j3
+    node_ids = nodes['node_id'].values
+    d2node = nodes['d2node'].values
+    n = len(node_ids)
+    starts = np.concatenate(([0], np.flatnonzero(node_ids[1:]!=node_ids[:-1]) + 1)) # First gpx point of every run of equal nodes
+    if len(starts)<2: # Fewer than two distinct nodes, nothing to route
+        return pd.DataFrame(columns=['node0','node1','gpx0','gpx1'], dtype=int)
     
-    return pieces
-
-def get_single_edge_coords(network, edge_id):
+    # Piece p runs from the node of run p to the node of run p+1, it ends at the gpx point of run p+1 that is nearest
+    # to its node, or at the last gpx point for the final piece (when run p+2 is missing or is the last gpx point)
+    ends = np.append(starts[2:], n) # First gpx point after run p+1
+    npieces = np.flatnonzero(ends>=n-1)[0] + 1
+    starts = starts[:npieces+1]
+    ends = ends[:npieces]
+    
+    # Nearest gpx point within each run, on ties the first one like idxmin
+    gpx1 = np.full(npieces, n-1)
+    if npieces>1:
+        d2node = d2node[starts[1]:ends[-2]]
+        offsets = starts[1:-1] - starts[1]
+        d_min = np.fmin.reduceat(d2node, offsets) # fmin skips NaN like idxmin
+        nearest = np.flatnonzero(d2node==np.repeat(d_min, ends[:-1] - starts[1:-1]))
+        gpx1[:-1] = nearest[np.searchsorted(nearest, offsets)] + starts[1]
+    gpx0 = np.concatenate(([0], gpx1[:-1]))
     
-    lon = list(network['edges'].loc[(edge_id[0],edge_id[1])]['geometry'][0].coords.xy[0])
-    lat = list(network['edges'].loc[(edge_id[0],edge_id[1])]['geometry'][0].coords.xy[1])
-    return [[coord[1],coord[0]] for coord in list(zip(lon,lat))]
+    return pd.DataFrame({'node0':node_ids[starts[:-1]], 'node1':node_ids[starts[1:]], 'gpx0':gpx0, 'gpx1':gpx1}).astype(int)
 
-# Extract the coordinates of the edge connecting node_id_start and node_id_end
-def get_segments(network, node_id_start, node_id_end):
+# Returns the [lat, lon] pairs of the GPX points spanned by a piece
+def get_piece_points(nodes, piece):
+    
+    nodes_select = nodes.loc[piece['gpx0']:piece['gpx1']] 
+    x = nodes_select['point_x'].values.tolist()
+    y = nodes_select['point_y'].values.tolist()
+    temp = list(zip(x,y))
+    return [[item[1],item[0]] for item in temp]
+
+# Routing length of a path, using the shortest of any parallel edges like the k-shortest-paths search does
+def get_route_length(network, path):
     
-    node_start   = network['points'].loc[node_id_start] # Start node with relevant information
-    node_end     = network['points'].loc[node_id_end]   # End node with relevant information
-    vertex_start = [node_start['y'], node_start['x']] # Coordinates of start node
-    vertex_end   = [node_end['y'],   node_end['x']]   # Coordinates of end node
-
-    # Selecting the corresponding edge
-    edge_id = [node_id_start, node_id_end] # Corresponding edge ID
-    try: # To deal with one-way streets
-        edge = network['edges'].loc[(node_id_start, node_id_end)] # Get coordinates of the points that make up that edge
-        edge_coords = get_single_edge_coords(network, [node_id_start, node_id_end])
-    except:
-        edge = network['edges'].loc[(node_id_end, node_id_start)] # Get coordinates of the points that make up that edge
-        edge_coords = edge_to_coords(network_edges, [node_id_end, node_id_start])
-        edge_coords = edge_coords[::-1]
-
-    # Filling the segment_list_raw list
-    segment_list = []
-    for j in range(0,len(edge_coords)-1): # Loop over all vertex pairs in the edge        
-        x0 = edge_coords[j][0]
-        y0 = edge_coords[j][1]
-        x1 = edge_coords[j+1][0]
-        y1 = edge_coords[j+1][1]
-        d_cart = cartesian_distance(x0,y0,x1,y1)
-        d_osm = edge['length'][0]/(len(edge_coords)-1) # just divide the length equally between segments
-        highway = edge['highway'][0]
-        surface = np.nan
-        tracktype = np.nan
-        if 'surface' in edge.columns:
-            surface = edge['surface'][0]
-        if 'tracktype' in edge.columns:
-            tracktype = edge['tracktype'][0]
-        segment_list.append([x0,y0,x1,y1,d_cart,d_osm,highway,surface,tracktype])
-
-    return segment_list
+    if 'csr' in network:
+        return gr_csr.get_path_length(network['csr'], path)
+    graph = network['graph']
+    return sum(min(edge['length'] for edge in graph[path[j]][path[j+1]].values()) for j in range(len(path)-1))
+
+# Selects the candidate path that best matches the GPX points of a piece, and returns its segments
+# Paths are pulled one at a time from the (lazy) paths generator, which yields them in order of increasing length.
+# The search stops once a bound shows that no later path can beat the best one so far, the selected path is the
+# same as when all candidates are evaluated. Also returns how many candidates were evaluated.
+def choose_best_route(network, paths, points, short):
+    
+    # Every path is at least as far from a GPX point as the nearest edge of the network
+    if not short:
+        err_bound = gr_mapmatch.get_error_bound(network, points)*(1 - 1e-9)
+    
+    routes = []
+    err = []
+    d = []
+    for path in paths:
+        
+        # Get segment coordinates, length and error of this path
+        segment_list = []
+        for j in range(len(path)-1):
+            segment_list.extend(gr_mapmatch.get_segments(network, path[j], path[j+1]))
+        routes.append(segment_list)
+        d_osm = 0
+        for segment in segment_list:
+            d_osm += segment[5] # add d_osm column
+        d.append(d_osm)
+        if not short:
+            err.append(gr_mapmatch.get_path_errors([segment_list],points)[0])
+        
+        # Later paths are at least as long as this one, check whether they can still win
+        d_bound = get_route_length(network, path)*(1 - 1e-9)
+        dmin = min(d)
+        if d_bound >= dmin: # dmin can no longer change
+            if short or err_bound*np.exp(d_bound/dmin) >= min(err[j]*np.exp(d[j]/dmin) for j in range(len(d))):
+                break
+
+    dmin = min(d)
+    weights = []
+    if short: # Pieces that span few GPX points are matched on length only
+        for j in range(len(d)): # Weight factor takes into account error and length
+            weights.append(d[j])
+    else:
+        for j in range(len(err)): # Weight factor takes into account error and length
+            weights.append(err[j]*np.exp(d[j]/dmin))
+
+    # Choose the best route
+    imin = weights.index(min(weights))
+    return routes[imin], len(routes)
 
 # Converts pieces dataframe into segments dataframe by performing pathfinding for each piece
-def pieces_to_segments(trail,nodes,points_per_batch,delta_roads,pieces,npaths):
+# The network is downloaded for one window of points_per_batch GPX points at a time and the pieces of every window are
+# routed independently, with workers>1 the windows are routed in parallel (see gr_parallel)
+# With a fetcher the networks of the next windows are downloaded while a window is routed (only with workers=1)
+# With contract=True the paths are searched on the pruned and contracted routing graph of every window (see gr_contract)
+# The shortest path trees of dijkstra_batch piece nodes are built per Dijkstra call (see gr_mapmatch.prepare_trees),
+# dijkstra_batch=0 runs a separate search for every piece
+# With return_candidates=True the number of candidate paths evaluated per piece is returned as well, pieces is not modified
+def pieces_to_segments(trail,nodes,points_per_batch,delta_roads,pieces,npaths,store=None,route_cache=None,workers=1,fetcher=None,
+                       contract=False,dijkstra_batch=16,return_candidates=False):
 
     n_trail = len(trail) # Number of GPX points in the trail
-    n1 = 0 # First point of this batch
-    n2 = min(n1 + points_per_batch, n_trail) # Last point of this batch (clipped)
-    lat_min, lat_max, lon_min, lon_max = gr_mapmatch.get_bbox(trail.loc[n1:n2],delta_roads) # Calculate the bounding box
-    network = gr_mapmatch.get_osm_network(lat_min, lat_max, lon_min, lon_max) # Download the street network from OSM
+    if workers!=1: # The route cache and the fetcher are not shared between processes
+        store = gr_parallel.get_worker_store(store)
+        route_cache = None
+        fetcher = None
+
+    # Assign the pieces to windows, a new window starts when a piece starts beyond the end of the current window
+    n2 = min(points_per_batch, n_trail) # Last point of the first window
+    window = []
+    w = 0
+    for gpx0 in pieces['gpx0'].values:
+        if gpx0>n2:
+            w += 1
+            n2 += points_per_batch
+        window.append(w)
+    window = np.array(window, dtype=int)
+
+    tasks = []
+    for w in range(window.max() + 1 if len(window)>0 else 0):
+        n1 = w*points_per_batch # First point of this window
+        n2 = min(points_per_batch, n_trail) + w*points_per_batch # Last point of this window
+        pieces_window = pieces[window==w]
+        nodes_window = nodes.loc[pieces_window['gpx0'].min():pieces_window['gpx1'].max()]
+        tasks.append((pieces_window, nodes_window, trail.loc[n1:n2], delta_roads, npaths, store, route_cache, pieces.shape[0],
+                      contract, dijkstra_batch))
+
+    # Networks of the windows that follow each window
+    bboxes = [gr_mapmatch.get_bbox(task[2], delta_roads) for task in tasks]
+    tasks = [task + (fetcher, bboxes[w+1:]) for w, task in enumerate(tasks)]
+    results = gr_parallel.run_batches(route_pieces_window, tasks, workers, label='window')
+
+    total_route = [segment for route_window, candidates_window in results for segment in route_window]
+    candidates = [ncandidates for route_window, candidates_window in results for ncandidates in candidates_window]
+
+    print('')
+    print(f'Evaluated {sum(candidates)} candidate paths for {len(candidates)} pieces (at most {npaths} per piece)')
+    if route_cache is not None:
+        gr_routecache.print_stats(route_cache)
+
+    segments = pd.DataFrame(total_route,columns=['x0','y0','x1','y1','d_cart','d_osm','highway','surface','tracktype'])
+    if return_candidates: # Number of candidate paths that were evaluated per piece
+        return segments, pd.Series(candidates, index=pieces.index, name='ncandidates', dtype=np.int64)
+    return segments
+
+# Routes the pieces of a single window, trail_window holds the GPX points of the window
+# Returns the list of segments and the number of candidate paths evaluated per piece
+def route_pieces_window(pieces, nodes, trail_window, delta_roads, npaths, store=None, route_cache=None, n_pieces=None,
+                        contract=False, dijkstra_batch=16, fetcher=None, next_bboxes=()):
+
+    gr_mapmatch.prefetch_networks(fetcher, next_bboxes, store)
+    lat_min, lat_max, lon_min, lon_max = gr_mapmatch.get_bbox(trail_window,delta_roads) # Calculate the bounding box
+    network = gr_mapmatch.get_osm_network(lat_min, lat_max, lon_min, lon_max, store, fetcher) # Download the street network from OSM
+    node_ids = np.concatenate((pieces['node0'].values, pieces['node1'].values)) # Nodes that are routed between
+    node_pairs = list(zip(pieces['node0'].values, pieces['node1'].values)) # Pairs that are routed between
+    if contract:
+        network = gr_contract.prepare_routing(network, node_ids)
+    else:
+        network = gr_mapmatch.drop_graph(network) # The window is only routed on its CSR graph
+    if not contract and dijkstra_batch>0:
+        network = gr_mapmatch.prepare_trees(network, node_pairs, dijkstra_batch)
 
     total_route = []
-#     total_route = pd.DataFrame()
+    candidates = []
 
     for idx, row in pieces.iterrows():
 
-        print_overwrite(f"\rHandling piece {idx} of {pieces.shape[0]}, spanning GPX points {row['gpx0']} through {row['gpx1']}")
+        print_overwrite(f"\rHandling piece {idx} of {n_pieces}, spanning GPX points {row['gpx0']} through {row['gpx1']}")
 
         # --- Grab GPX points to be used in error calculation
-        nodes_select = nodes.loc[row['gpx0']:row['gpx1']] 
-        x = nodes_select['point_x'].values.tolist()
-        y = nodes_select['point_y'].values.tolist()
-        temp = list(zip(x,y))
-        points = [[item[1],item[0]] for item in temp]
-
-        # --- Check if we need to download the next network
-        if row['gpx0']>n2:
-            n1 += points_per_batch
-            n2 += points_per_batch
-#             print('')
-            lat_min, lat_max, lon_min, lon_max = gr_mapmatch.get_bbox(trail.loc[n1:n2],delta_roads) # Calculate the bounding box
-            network = gr_mapmatch.get_osm_network(lat_min, lat_max, lon_min, lon_max) # Download the street network from OSM
+        points = get_piece_points(nodes, row)
 
-        # --- Calculate paths
+        # --- Calculate paths and choose the best one
         found = False
         ntry = 1
         while not found: # in case the node is not in the network, reload it with bigger delta
             try:
-                route = ox.k_shortest_paths(network['graph'], row['node0'], row['node1'], npaths)
-                paths = []
-                for path in route:
-                    paths.append(path)
-            except:
-#                 print('')
+                paths = gr_mapmatch.get_k_paths(network, row['node0'], row['node1'], npaths, route_cache) # Generator, paths are computed when pulled
+                best_route, ncandidates = choose_best_route(network, paths, points, row['gpx1'] - row['gpx0'] < 4)
+            except (nx.NodeNotFound, nx.NetworkXNoPath):
                 print('   Node not found in network, downloading larger network...')
-#                 print(f"nodes are {row['node0']} and {row['node1']}")
-#                 print(f'first has coords {} {}')
-#                 print(f'bbox used was {lat_min} {lat_max} {lon_min} {lon_max}')
-                lat_min, lat_max, lon_min, lon_max = gr_mapmatch.get_bbox(trail.loc[n1:n2],ntry*delta_roads) # Calculate the bounding box
-                network = gr_mapmatch.get_osm_network(lat_min, lat_max, lon_min, lon_max) # Download the street network from OSM
+                lat_min, lat_max, lon_min, lon_max = gr_mapmatch.get_bbox(trail_window,ntry*delta_roads) # Calculate the bounding box
+                network = gr_mapmatch.get_osm_network(lat_min, lat_max, lon_min, lon_max, store, fetcher) # Download the street network from OSM
+                if contract:
+                    network = gr_contract.prepare_routing(network, node_ids)
+                else:
+                    network = gr_mapmatch.drop_graph(network)
+                if not contract and dijkstra_batch>0:
+                    network = gr_mapmatch.prepare_trees(network, node_pairs, dijkstra_batch)
                 ntry += 1
             else:
                 found = True
 
-        # --- Choose the best path
-
-        # Get segment coordinates for each path
-        routes = []
-        for path in paths:
-            segment_list = []
-            for j in range(len(path)-1):
-                segment_list.extend(get_segments(network, path[j], path[j+1]))
-            routes.append(segment_list)
-
-        # Get the error for each path
-        err = []
-        d = []
-        for route in routes:
-            err.append(get_path_error(route,points))
-            d_osm = 0
-            for segment in route:
-                d_osm += segment[5] # add d_osm column
-            d.append(d_osm)
-        dmin = min(d)
-        weights = []
-        if row['gpx1'] - row['gpx0'] < 4:
-            for j in range(len(err)): # Weight factor takes into account error and length
-                weights.append(d[j])
-        else:
-            for j in range(len(err)): # Weight factor takes into account error and length
-                weights.append(err[j]*np.exp(d[j]/dmin))
-
-        # Choose the best route
-        imin = weights.index(min(weights))
-        best_route = routes[imin]
         total_route.extend(best_route)
+        candidates.append(ncandidates)
+
+    return total_route, candidates
+
+####################################################
+## --- Region-wide single-graph road matching --- ##
+####################################################
 
-    return pd.DataFrame(total_route,columns=['x0','y0','x1','y1','d_cart','d_osm','highway','surface','tracktype'])
\ No newline at end of file
+# Converts gpx points to nodes dataframe, matching all points in one pass against a single corridor network
+# (see gr_mapmatch.get_corridor_network), so there is no bbox boundary to recalculate around
+def gpx_to_nodes_corridor(gpx, gpx_coords, network):
+
+    node_id = np.array(gr_mapmatch.match_nodes_vec(network,gpx_coords)) # Calculate corresponding node for each GPX point
+    point_y = gpx['latitude'].values
+    point_x = gpx['longitude'].values
+    node_x = network['points'].loc[node_id,'x'].values
+    node_y = network['points'].loc[node_id,'y'].values
+
+    # Distance from GPX point to node, and from node to the border of the corridor
+    d2node = gr_mapmatch.get_dist([point_y,point_x],[node_y,node_x])
+    d2bbox = shapely.distance(network['corridor'].boundary, shapely.points(node_x,node_y))
+
+    return pd.DataFrame({'point_x':point_x, 'point_y':point_y,
+                         'node_id':node_id,
+                         'node_x':node_x, 'node_y':node_y,
+                         'd2node':d2node, 'd2bbox':d2bbox},index=gpx.index)
+
+# Returns the GPX points spanned by a piece as a trail dataframe with latitude and longitude columns
+def get_piece_trail(nodes, piece):
+    
+    nodes_select = nodes.loc[piece['gpx0']:piece['gpx1']]
+    return pd.DataFrame({'latitude':nodes_select['point_y'].values, 'longitude':nodes_select['point_x'].values},
+                        index=nodes_select.index)
+
+# Converts pieces dataframe into segments dataframe, performing all pathfinding on a single corridor network
+# Pieces without a path inside the corridor (e.g. when its border cuts a one-way street) are routed on a bbox network
+# around their own GPX points instead, see route_pieces_window, which grows by delta_roads until the path is found
+# With contract=True the paths are searched on the pruned and contracted routing graph (see gr_contract)
+# The shortest path trees of dijkstra_batch piece nodes are built per Dijkstra call (see gr_mapmatch.prepare_trees)
+# With return_candidates=True the number of candidate paths evaluated per piece is returned as well, pieces is not modified
+def pieces_to_segments_corridor(nodes,pieces,npaths,network,route_cache=None,contract=False,dijkstra_batch=16,
+                                return_candidates=False,delta_roads=0.010,store=None):
+
+    if contract:
+        network = gr_contract.prepare_routing(network, np.concatenate((pieces['node0'].values, pieces['node1'].values)))
+        gr_contract.print_stats(network)
+    elif dijkstra_batch>0:
+        network = gr_mapmatch.prepare_trees(network, zip(pieces['node0'].values, pieces['node1'].values), dijkstra_batch)
+    total_route = []
+    candidates = []
+    outside = [] # Pieces that were routed outside the corridor
+
+    for idx, row in pieces.iterrows():
+
+        print_overwrite(f"\rHandling piece {idx} of {pieces.shape[0]}, spanning GPX points {row['gpx0']} through {row['gpx1']}")
+
+        # --- Grab GPX points to be used in error calculation
+        points = get_piece_points(nodes, row)
+
+        # --- Calculate paths and choose the best one
+        try:
+            paths = gr_mapmatch.get_k_paths(network, row['node0'], row['node1'], npaths, route_cache) # Generator, paths are computed when pulled
+            best_route, ncandidates = choose_best_route(network, paths, points, row['gpx1'] - row['gpx0'] < 4)
+        except (nx.NodeNotFound, nx.NetworkXNoPath):
+            print(f'   No path inside the corridor for piece {idx}, routing it on a bbox network...')
+            route_window, candidates_window = route_pieces_window(pieces.loc[[idx]], nodes, get_piece_trail(nodes, row),
+                                                                  delta_roads, npaths, store, n_pieces=pieces.shape[0],
+                                                                  dijkstra_batch=0)
+            best_route, ncandidates = route_window, candidates_window[0]
+            outside.append(idx)
+        total_route.extend(best_route)
+        candidates.append(ncandidates)
+
+    print('')
+    print(f'Evaluated {sum(candidates)} candidate paths for {len(candidates)} pieces (at most {npaths} per piece)')
+    if len(outside)>0:
+        print(f'Routed {len(outside)} piece(s) outside the corridor: {outside}')
+    if network.get('trees') is not None:
+        gr_csr.print_tree_stats(network['trees'])
+    if route_cache is not None:
+        gr_routecache.print_stats(route_cache)
+
+    segments = pd.DataFrame(total_route,columns=['x0','y0','x1','y1','d_cart','d_osm','highway','surface','tracktype'])
+    if return_candidates: # Number of candidate paths that were evaluated per piece
+        return segments, pd.Series(candidates, index=pieces.index, name='ncandidates', dtype=np.int64)
+    return segments
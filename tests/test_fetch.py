@@ -0,0 +1,67 @@
+import sys
+import os.path
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import osmnx as ox
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import gr_fetch
+import gr_mapmatch
+
+# Canned Overpass response with a single street of three nodes
+elements = [{'type':'node', 'id':1, 'lat':50.002, 'lon':5.002}, {'type':'node', 'id':2, 'lat':50.005, 'lon':5.005},
+            {'type':'node', 'id':3, 'lat':50.008, 'lon':5.008},
+            {'type':'way', 'id':10, 'nodes':[1, 2, 3], 'tags':{'highway':'residential'}}]
+
+# Local stand-in for the Overpass API, every third request fails with a 500 response
+class Handler(BaseHTTPRequestHandler):
+
+    requests = 0
+    running = 0
+    max_running = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        with Handler.lock:
+            Handler.requests += 1
+            Handler.running += 1
+            Handler.max_running = max(Handler.max_running, Handler.running)
+            fail = Handler.requests%3==0
+        time.sleep(0.05)
+        body = b'Internal Server Error' if fail else json.dumps({'version':0.6, 'elements':elements}).encode()
+        self.send_response(500 if fail else 200)
+        self.send_header('Content-Type', 'text/plain' if fail else 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with Handler.lock:
+            Handler.running -= 1
+
+    def log_message(self, *args):
+        pass
+
+def test_fetcher_against_stand_in_server(monkeypatch):
+
+    monkeypatch.setattr(ox.settings, 'use_cache', False)
+    monkeypatch.setattr(ox.settings, 'overpass_rate_limit', False)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    overpass_url = ox.settings.overpass_url
+    try:
+        fetcher = gr_fetch.open_fetcher(lookahead=3, concurrency=2, rate=None, retries=3, backoff=0.01,
+                                        endpoint=f'http://127.0.0.1:{server.server_port}/api')
+        bboxes = [(50.0, 50.01 + 0.001*j, 5.0, 5.01) for j in range(4)]
+        for bbox in bboxes[1:]:
+            gr_fetch.prefetch(fetcher, ('graph',) + bbox, gr_mapmatch.download_graph, *bbox)
+        graphs = [gr_fetch.fetch(fetcher, ('graph',) + bbox, gr_mapmatch.download_graph, *bbox) for bbox in bboxes]
+        gr_fetch.close_fetcher(fetcher)
+    finally:
+        server.shutdown()
+
+    assert all(sorted(graph.nodes)==[1, 3] for graph in graphs) # Simplified to the end nodes of the street
+    assert fetcher['hits']==3 and fetcher['misses']==1
+    assert fetcher['retried']>=1 and Handler.requests==4 + fetcher['retried']
+    assert Handler.max_running<=2
+    assert ox.settings.overpass_url==overpass_url
@@ -0,0 +1,30 @@
+import sys
+import os.path
+import pytest
+from osmnx._errors import InsufficientResponseError, ResponseStatusCodeError
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import gr_graphstore
+
+def raise_error(error):
+    def download_tile(store, key):
+        raise error
+    return download_tile
+
+def test_empty_tile_is_stored(tmp_path, monkeypatch):
+
+    store = gr_graphstore.open_store(str(tmp_path))
+    monkeypatch.setattr(gr_graphstore, 'download_tile', raise_error(InsufficientResponseError('no nodes')))
+    tile = gr_graphstore.get_tile(store, (1000, 100))
+    assert len(tile)==0
+    assert os.path.isfile(gr_graphstore.get_tile_filename(store, (1000, 100)))
+    assert (1000, 100) in gr_graphstore.open_store(str(tmp_path))['tiles']
+
+def test_failed_download_is_not_stored(tmp_path, monkeypatch):
+
+    store = gr_graphstore.open_store(str(tmp_path))
+    monkeypatch.setattr(gr_graphstore, 'download_tile', raise_error(ResponseStatusCodeError('429 Too Many Requests')))
+    with pytest.raises(ResponseStatusCodeError):
+        gr_graphstore.get_tile(store, (1000, 100))
+    assert not os.path.isfile(gr_graphstore.get_tile_filename(store, (1000, 100)))
+    assert (1000, 100) not in store['tiles'] and (1000, 100) not in store['memory']
+    assert (1000, 100) not in gr_graphstore.open_store(str(tmp_path))['tiles']
@@ -0,0 +1,33 @@
+import sys
+import os
+import pytest
+from osmnx._errors import InsufficientResponseError, ResponseStatusCodeError
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import gr_placematch
+
+def raise_error(error):
+    def geometries_from_polygon(polygon, tags):
+        raise error
+    return geometries_from_polygon
+
+def test_empty_landuse_tile_is_stored(tmp_path, monkeypatch):
+
+    cache = gr_placematch.open_landuse_cache(str(tmp_path))
+    monkeypatch.setattr(gr_placematch.ox, 'geometries_from_polygon', raise_error(InsufficientResponseError('no features')))
+    assert gr_placematch.get_landuse_tile(cache, (1000, 100), 0.00015, 15.0e-6)==[]
+    assert os.path.isfile(gr_placematch.get_landuse_filename(cache, (1000, 100), 0.00015, 15.0e-6))
+
+def test_failed_landuse_download_is_not_stored(tmp_path, monkeypatch):
+
+    cache = gr_placematch.open_landuse_cache(str(tmp_path))
+    monkeypatch.setattr(gr_placematch.ox, 'geometries_from_polygon', raise_error(ResponseStatusCodeError('504 Gateway Timeout')))
+    with pytest.raises(ResponseStatusCodeError):
+        gr_placematch.get_landuse_tile(cache, (1000, 100), 0.00015, 15.0e-6)
+    assert os.listdir(str(tmp_path))==[]
+
+def test_landuse_tiles_depend_on_the_grid(tmp_path):
+
+    filenames = {gr_placematch.get_landuse_filename(gr_placematch.open_landuse_cache(str(tmp_path), tile_size, margin),
+                                                    (1000, 100), 0.00015, 15.0e-6)
+                 for tile_size, margin in [(0.05, 0.01), (0.1, 0.01), (0.05, 0.02)]}
+    assert len(filenames)==3
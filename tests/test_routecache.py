@@ -0,0 +1,29 @@
+import sys
+import os.path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import gr_routecache
+
+query = ('k', 1, 2)
+entry = {'paths':[[1, 3, 2]], 'lengths':[25.0], 'complete':False}
+
+def test_shared_entry_is_checked_on_other_networks(tmp_path):
+
+    cache = gr_routecache.open_route_cache(str(tmp_path))
+    gr_routecache.store(cache, {'version':'a', 'region':'store'}, query, entry, shared=True)
+    other = {'version':'b', 'region':'store'}
+    assert gr_routecache.lookup(cache, other, query, lambda entry: False) is None
+    assert gr_routecache.lookup(cache, other, query, lambda entry: True)==entry
+    assert gr_routecache.lookup(cache, {'version':'c'}, query, lambda entry: True) is None # Not cut from the store
+    gr_routecache.close_route_cache(cache)
+
+def test_worker_entries_are_merged(tmp_path):
+
+    cache = gr_routecache.open_route_cache(str(tmp_path), worker=True)
+    gr_routecache.store(cache, {'version':'a', 'region':'store'}, query, entry, shared=True)
+    gr_routecache.close_route_cache(cache)
+    assert gr_routecache.merge_route_cache(str(tmp_path))==1
+    assert not os.path.isfile(gr_routecache.get_shelf_filename(str(tmp_path), os.getpid()) + '.dat')
+
+    cache = gr_routecache.open_route_cache(str(tmp_path), worker=True) # Reads the shared store
+    assert gr_routecache.lookup(cache, {'version':'b', 'region':'store'}, query, lambda entry: True)==entry
+    gr_routecache.close_route_cache(cache)
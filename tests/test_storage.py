@@ -0,0 +1,47 @@
+import sys
+import os.path
+from csv import writer
+import pandas as pd
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import gr_storage
+import gr_utils
+
+headers = ['x0','y0','x1','y1','d_cart','d_osm','highway','surface','tracktype']
+rows = [[50.1, 5.2, 50.2, 5.3, 12.5, 13.0, 'track', 'gravel', 'grade2'],
+        [50.2, 5.3, 50.3, 5.4, 7.25, 7.5, 'residential', '', '']]
+
+# Road batch as written by the csv.writer of older runs, without an index column
+def write_legacy_batch(filename):
+
+    with open(filename, 'w', newline='') as file:
+        csv_writer = writer(file)
+        csv_writer.writerow(headers)
+        for row in rows:
+            csv_writer.writerow(row)
+
+def test_read_legacy_roads_batch(tmp_path):
+
+    filename_base = str(tmp_path / 'gr000_roads_0to100')
+    write_legacy_batch(filename_base + '.csv')
+    data = gr_storage.read_stage(filename_base, 'roads')
+    assert list(data.columns)==headers
+    assert data['x0'].tolist()==[50.1, 50.2]
+    assert data['highway'].tolist()==['track', 'residential']
+
+def test_merge_legacy_roads_batches(tmp_path):
+
+    batch_files = [str(tmp_path / 'gr000_roads_0to100'), str(tmp_path / 'gr000_roads_100to200')]
+    for filename_base in batch_files:
+        write_legacy_batch(filename_base + '.csv')
+    data = gr_utils.merge_roads('gr000', None, 100, batch_files=batch_files)
+    assert list(data.columns)==headers
+    assert data['x0'].tolist()==[50.1, 50.2, 50.1, 50.2]
+
+def test_csv_round_trip_keeps_index(tmp_path):
+
+    data = pd.DataFrame(rows, columns=headers, index=[3, 7])
+    filename_base = str(tmp_path / 'gr000_roads')
+    gr_storage.write_stage(data, filename_base, 'roads', fmt='csv')
+    data_read = gr_storage.read_stage(filename_base, 'roads', fmt='csv')
+    assert data_read.index.tolist()==[3, 7]
+    assert data_read['x0'].tolist()==[50.1, 50.2]
@@ -0,0 +1,25 @@
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import gr_utils
+
+def write_gpx(filename, points):
+
+    with open(filename, 'w') as file:
+        file.write('<?xml version="1.0"?>\n<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>\n')
+        for lat, lon in points:
+            file.write(f'<trkpt lat="{lat}" lon="{lon}"><ele>10.0</ele></trkpt>\n')
+        file.write('</trkseg></trk></gpx>\n')
+
+def test_changed_gpx_is_parsed_again(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data_input')
+    os.makedirs('data_output')
+    write_gpx('data_input/gr000.gpx', [(50.1, 5.2), (50.2, 5.3)])
+    assert gr_utils.get_gpx('gr000')['latitude'].tolist()==[50.1, 50.2]
+    assert gr_utils.get_gpx('gr000')['latitude'].tolist()==[50.1, 50.2] # From the parsed .npz file
+    write_gpx('data_input/gr000.gpx', [(50.1, 5.2), (50.2, 5.3), (50.3, 5.4)])
+    trail = gr_utils.get_gpx('gr000')
+    assert trail['latitude'].tolist()==[50.1, 50.2, 50.3]
+    assert 'source' not in trail.columns